@@ -0,0 +1,169 @@
+"""An offline stand-in for the parts of the Discord API the bot uses.
+
+Guilds, channels, emojis and messages are plain objects whose REST calls go through `FakeBackend`, which
+adds latency and enforces per-route and global rate limits. Like discord.py's HTTP client, it sleeps
+through a 429 and retries up to 5 times before raising it.
+"""
+import asyncio
+import collections
+import itertools
+import random
+import time
+from types import SimpleNamespace
+
+import discord
+
+
+_ids = itertools.count(1 << 40)
+
+
+class FakeResponse:
+    def __init__(self, status, reason, retry_after):
+        self.status = status
+        self.reason = reason
+        # Discord's own 429s come through its proxy; Cloudflare bans don't have the header
+        self.headers = {'Retry-After': str(retry_after), 'Via': '1.1 google'}
+
+
+class Bucket:
+    def __init__(self, limit, per):
+        self.limit = limit
+        self.per = per
+        self.hits = collections.deque()
+
+    def retry_after(self, now):
+        while self.hits and self.hits[0] <= now - self.per:
+            self.hits.popleft()
+        if len(self.hits) >= self.limit:
+            return self.hits[0] + self.per - now
+        self.hits.append(now)
+        return 0
+
+
+class FakeBackend:
+    """Simulated REST API: every call waits `latency` seconds (+/- jitter) and may be rate limited."""
+
+    def __init__(self, latency=0.05, jitter=0.02, route_limit=(5, 5.0), global_limit=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.route_limit = route_limit
+        self.global_bucket = Bucket(*global_limit) if global_limit else None
+        self.buckets = {}
+        self.random = random.Random(seed)
+        self.requests = collections.Counter()
+        self.rate_limited = collections.Counter()
+        self.sends = []
+
+    async def request(self, route, tries=5):
+        for attempt in range(tries):
+            retry_after = self._retry_after(route)
+            if not retry_after:
+                break
+            self.rate_limited[route.split(':')[0]] += 1
+            if attempt == tries - 1:
+                raise discord.HTTPException(FakeResponse(429, 'Too Many Requests', retry_after), 'You are being rate limited.')
+            await asyncio.sleep(retry_after)
+        self.requests[route.split(':')[0]] += 1
+        await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+
+    def _retry_after(self, route):
+        now = time.monotonic()
+        for bucket in filter(None, (self.global_bucket, self._bucket(route))):
+            retry_after = bucket.retry_after(now)
+            if retry_after:
+                return retry_after
+        return 0
+
+    def _bucket(self, route):
+        if not self.route_limit:
+            return None
+        bucket = self.buckets.get(route)
+        if bucket is None:
+            bucket = self.buckets[route] = Bucket(*self.route_limit)
+        return bucket
+
+    def peak_send_rate(self, window=1.0):
+        """Largest number of messages sent within any `window` seconds."""
+        sends = sorted(self.sends)
+        peak = 0
+        start = 0
+        for end, ts in enumerate(sends):
+            while sends[start] <= ts - window:
+                start += 1
+            peak = max(peak, end - start + 1)
+        return peak
+
+
+class FakeMessage:
+    def __init__(self, backend, channel, content, embed):
+        self.id = next(_ids)
+        self.backend = backend
+        self.channel = channel
+        self.content = content
+        self.embed = embed
+        self.reactions = []
+
+    async def add_reaction(self, emoji):
+        await self.backend.request('reaction:%d' % self.channel.id)
+        self.reactions.append(emoji)
+
+
+class FakeTextChannel:
+    def __init__(self, backend, guild, name):
+        self.id = next(_ids)
+        self.backend = backend
+        self.guild = guild
+        self.name = name
+        self.messages = []
+
+    @property
+    def mention(self):
+        return '<#%d>' % self.id
+
+    async def send(self, content=None, *, embed=None):
+        await self.backend.request('send:%d' % self.id)
+        self.backend.sends.append(time.monotonic())
+        msg = FakeMessage(self.backend, self, content, embed)
+        self.messages.append(msg)
+        return msg
+
+
+class FakeGuild:
+    def __init__(self, backend, guild_id, channels=('general', 'memes'), emojis=('wednesday',), embed_links=True):
+        self.id = guild_id
+        self.backend = backend
+        self.name = 'guild-%d' % guild_id
+        self.description = None
+        self.member_count = 10
+        self.region = 'us-east'
+        self.shard_id = 0
+        self.text_channels = [FakeTextChannel(backend, self, name) for name in channels]
+        self.voice_channels = []
+        self.channels = list(self.text_channels)
+        self.emojis = [SimpleNamespace(id=next(_ids), name=name) for name in emojis]
+        self.default_role = SimpleNamespace(id=guild_id, name='@everyone')
+        self.roles = [self.default_role]
+        self.me = SimpleNamespace(guild_permissions=discord.Permissions(embed_links=embed_links, manage_messages=True))
+
+    def get_channel(self, channel_id):
+        for channel in self.channels:
+            if channel.id == channel_id:
+                return channel
+
+    def get_role(self, role_id):
+        for role in self.roles:
+            if role.id == role_id:
+                return role
+
+    async def create_custom_emoji(self, *, name, image):
+        await self.backend.request('emoji:%d' % self.id)
+        emoji = SimpleNamespace(id=next(_ids), name=name)
+        self.emojis.append(emoji)
+        return emoji
+
+
+def install(bot, guilds):
+    """Make `bot` see `guilds` as its connected guilds."""
+    bot._connection._guilds.clear()
+    for guild in guilds:
+        bot._connection._guilds[guild.id] = guild
@@ -0,0 +1,58 @@
+"""A local HTTP stand-in for the image hosts memes are submitted from.
+
+Paths select the response, so a mix of URLs exercises every outcome of the verifier:
+
+    /image/<n>      a small PNG; images with the same n % distinct share content
+    /missing/<n>    404
+    /page/<n>       an HTML page
+    /large/<n>      an image bigger than the verifier's size limit
+    /redirect/<n>   a redirect to /image/<n> by way of localhost, which the verifier must refuse to follow
+"""
+import asyncio
+import random
+
+from aiohttp import web
+
+
+PNG_HEADER = b'\x89PNG\r\n\x1a\n'
+
+
+class FakeImageHost:
+    def __init__(self, latency=0.02, distinct=1000, image_size=32 << 10, large_size=16 << 20):
+        self.latency = latency
+        self.distinct = distinct
+        self.image_size = image_size
+        self.large_size = large_size
+        self.requests = 0
+        self.runner = None
+        self.port = None
+        self.url = None
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        kind, n = request.match_info['kind'], int(request.match_info['n'])
+        if kind == 'image':
+            body = PNG_HEADER + random.Random(n % self.distinct).getrandbits(8 * self.image_size).to_bytes(self.image_size, 'big')
+            return web.Response(body=body, content_type='image/png')
+        if kind == 'page':
+            return web.Response(text='<html></html>', content_type='text/html')
+        if kind == 'large':
+            return web.Response(body=bytes(self.large_size), content_type='image/png')
+        if kind == 'redirect':
+            raise web.HTTPFound('http://localhost:%d/image/%d' % (self.port, n))
+        raise web.HTTPNotFound()
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_get('/{kind}/{n:\\d+}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.url = 'http://%s:%d' % (host, self.port)
+        return self.url
+
+    async def stop(self):
+        await self.runner.cleanup()
@@ -0,0 +1,82 @@
+"""Benchmark get_guild_meme against the old ORDER BY RANDOM() queries.
+
+    python -m benchmarks.meme_selection --memes 100000 --guilds 10000
+
+Prints a JSON report. The old queries are timed on a sample of guilds since they are too slow to run for all.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+OLD_GUILD_QUERY = 'SELECT * FROM guild_memes WHERE guild_id=? AND last_posted IS NULL ORDER BY RANDOM() LIMIT 1'
+OLD_GLOBAL_QUERY = 'SELECT * FROM global_memes WHERE NOT EXISTS (SELECT 1 FROM guild_memes WHERE guild_id=? AND url=global_memes.url AND last_posted IS NOT NULL) ORDER BY RANDOM() LIMIT 1'
+
+
+def old_get_guild_meme(db, guild_id):
+    for row in db.execute(OLD_GUILD_QUERY, (guild_id,)):
+        return row['url']
+    for row in db.execute(OLD_GLOBAL_QUERY, (guild_id,)):
+        return row['url']
+
+
+def populate(database, memes, guilds, guild_memes, posted):
+    db = database.db
+    with db:
+        db.executemany('INSERT INTO global_memes (url, approved, shuffle_key) VALUES (?, 1, ?)',
+                (('https://example.com/global/%d.png' % i, database._random_shuffle_key()) for i in range(memes)))
+        for guild_id in range(1, guilds + 1):
+            # half the guilds have their own queue, the rest fall back to the global queue
+            if guild_id % 2:
+                db.executemany('INSERT INTO guild_memes (guild_id, url) VALUES (?, ?)',
+                        ((guild_id, 'https://example.com/%d/%d.png' % (guild_id, i)) for i in range(guild_memes)))
+            db.executemany("INSERT INTO guild_memes (guild_id, url, last_posted) VALUES (?, ?, datetime('now'))",
+                    ((guild_id, 'https://example.com/global/%d.png' % i) for i in random.sample(range(memes), posted)))
+
+
+def timed(fn, guild_ids):
+    started = time.perf_counter()
+    for guild_id in guild_ids:
+        fn(guild_id)
+    elapsed = time.perf_counter() - started
+    return {'guilds': len(guild_ids), 'total_s': elapsed, 'per_guild_ms': 1000 * elapsed / len(guild_ids)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--memes', type=int, default=100000)
+    parser.add_argument('--guilds', type=int, default=10000)
+    parser.add_argument('--guild-memes', type=int, default=10)
+    parser.add_argument('--posted', type=int, default=20)
+    parser.add_argument('--sample', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DB_FILE'] = os.path.join(tmp, 'bench.db')
+        from wednesday_bot import database
+
+        started = time.perf_counter()
+        populate(database, args.memes, args.guilds, args.guild_memes, args.posted)
+        setup = time.perf_counter() - started
+
+        guild_ids = list(range(1, args.guilds + 1))
+        sample = random.sample(guild_ids, min(args.sample, len(guild_ids)))
+        report = {
+            'params': vars(args),
+            'setup_s': setup,
+            'old': timed(lambda guild_id: old_get_guild_meme(database.db, guild_id), sample),
+            'new': timed(database.get_guild_meme, guild_ids),
+        }
+        report['speedup'] = report['old']['per_guild_ms'] / report['new']['per_guild_ms']
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
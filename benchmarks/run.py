@@ -0,0 +1,335 @@
+"""Offline benchmark suite for the scheduler, do_post, reschedule and the database layer.
+
+    python -m benchmarks.run [--output results.json] [--scenario NAME ...]
+
+Each scenario runs in its own process against a fresh database and the fake Discord backend in
+benchmarks/fake_discord.py. Inputs are seeded, so runs are comparable; the JSON report lists the
+parameters alongside the results.
+"""
+import argparse
+import asyncio
+import dataclasses
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+
+SCENARIOS = ('startup', 'burst', 'spread', 'meme_selection', 'settings_churn', 'verify')
+
+
+def _setup(args):
+    os.environ.setdefault('DISCORD_CLIENT_ID', '0')
+    os.environ.setdefault('DISCORD_SUPER_ADMIN', '0')
+    os.environ['SHARD_HEALTH_INTERVAL'] = '3600'
+    from wednesday_bot import bot, database
+    from benchmarks.fake_discord import FakeBackend
+    random.seed(args.seed)
+    backend = FakeBackend(latency=args.latency, jitter=args.latency / 2,
+            global_limit=(args.global_rate, 1.0) if args.global_rate else None, seed=args.seed)
+    return bot, database, backend
+
+
+def _shutdown(loop):
+    tasks = [task for task in asyncio.all_tasks(loop) if not task.done()]
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
+def _populate_settings(database, guilds, modes=('Classic', 'Text', 'Variety')):
+    rows = []
+    for i, guild in enumerate(guilds):
+        rows.append((guild.id, 'channel', 'memes'))
+        rows.append((guild.id, 'mode', modes[i % len(modes)]))
+        if i % 4 == 0:
+            rows.append((guild.id, 'timezone', random.choice(['America/Chicago', 'Europe/London', 'Asia/Tokyo'])))
+    with database.db:
+        database.db.executemany('INSERT INTO guild_settings VALUES (?, ?, ?)', rows)
+
+
+def startup(args):
+    """on_ready with many guilds: time until scheduled, and until the background emoji work finishes."""
+    B, database, backend = _setup(args)
+    from benchmarks.fake_discord import FakeGuild, install
+    guilds = [FakeGuild(backend, 1000 + i, emojis=() if i % 10 == 0 else ('wednesday',)) for i in range(args.guilds)]
+    _populate_settings(database, guilds)
+    install(B.bot, guilds)
+    loop = B.bot.loop
+
+    async def wait_for_emojis():
+        while not all(any(emoji.name == 'wednesday' for emoji in guild.emojis) for guild in guilds):
+            await asyncio.sleep(0.01)
+
+    started = time.perf_counter()
+    loop.run_until_complete(B.on_ready())
+    ready = time.perf_counter() - started
+    loop.run_until_complete(wait_for_emojis())
+    emojis = time.perf_counter() - started
+    result = {
+        'guilds': len(guilds),
+        'ready_s': ready,
+        'emojis_done_s': emojis,
+        'scheduler_heap_size': len(B.bot.scheduler),
+        'scheduler_pending': B.bot.scheduler.pending,
+        'requests': dict(backend.requests),
+    }
+    _shutdown(loop)
+    return result
+
+
+def burst(args):
+    """Every guild due at the same instant, as on Wednesday at 09:30."""
+    B, database, backend = _setup(args)
+    from benchmarks.fake_discord import FakeGuild, install
+    from benchmarks.meme_selection import populate
+    from wednesday_bot.scheduler import Scheduler
+    guilds = [FakeGuild(backend, 1000 + i) for i in range(args.burst_guilds)]
+    _populate_settings(database, guilds)
+    populate(database, 1000, 0, 0, 0)
+    # every other guild posts from its own queue rather than the global one
+    for guild in guilds[::2]:
+        database.add_guild_memes(guild.id, ['https://example.com/%d/%d.png' % (guild.id, i) for i in range(3)])
+    install(B.bot, guilds)
+    loop = B.bot.loop
+    B.bot.scheduler = Scheduler(concurrency=args.concurrency, rate=args.post_rate or None, on_batch=B.log_batch)
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    B.bot.scheduler.join_many((guild.id, now, B.do_post) for guild in guilds)
+
+    started = time.perf_counter()
+    loop.run_until_complete(B.bot.scheduler.tick())
+    duration = time.perf_counter() - started
+    # every Variety post must be marked as posted, whichever queue it came from
+    variety = [guild.id for i, guild in enumerate(guilds) if i % 3 == 2]
+    unmarked = [guild_id for guild_id in variety if database.get_queue_stats(guild_id)['posted'] != 1]
+    if B.bot.scheduler.last_batch.failures or unmarked:
+        raise AssertionError('%d posts failed, %d Variety posts not marked as posted'
+                % (B.bot.scheduler.last_batch.failures, len(unmarked)))
+    result = {
+        'guilds': len(guilds),
+        'concurrency': args.concurrency,
+        'post_rate': args.post_rate,
+        'duration_s': duration,
+        'posts_per_s': len(guilds) / duration,
+        'peak_sends_per_s': backend.peak_send_rate(),
+        'batch': dataclasses.asdict(B.bot.scheduler.last_batch),
+        'requests': dict(backend.requests),
+        'rate_limited': dict(backend.rate_limited),
+    }
+    _shutdown(loop)
+    return result
+
+
+def spread(args):
+    """The burst again through the scheduler's run loop, without and then with posting windows."""
+    B, database, backend = _setup(args)
+    from benchmarks.fake_discord import FakeGuild, install
+    from wednesday_bot.scheduler import Scheduler
+    guilds = [FakeGuild(backend, 1000 + i) for i in range(args.burst_guilds)]
+    _populate_settings(database, guilds, modes=('Classic', 'Text'))
+    install(B.bot, guilds)
+    loop = B.bot.loop
+
+    def reacted():
+        return sum(len(msg.reactions) for guild in guilds for channel in guild.text_channels for msg in channel.messages)
+
+    async def run(window, spread_rate):
+        backend.sends.clear()
+        for guild in guilds:
+            for channel in guild.text_channels:
+                channel.messages.clear()
+        B.bot.scheduler = Scheduler(concurrency=args.concurrency, spread_rate=spread_rate)
+        due = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=window + 1)
+        B.bot.scheduler.join_many((guild.id, due, B.do_post, window) for guild in guilds)
+        runner = loop.create_task(B.bot.scheduler.run())
+        while reacted() < len(guilds):
+            await asyncio.sleep(0.05)
+        finished = datetime.datetime.now(tz=datetime.timezone.utc)
+        runner.cancel()
+        return {
+            'window_s': window,
+            'spread_rate': spread_rate,
+            'peak_sends_per_s': backend.peak_send_rate(),
+            'duration_s': max(backend.sends) - min(backend.sends),
+            'finished_after_schedule_s': (finished - due).total_seconds(),
+            'rate_limited': dict(backend.rate_limited),
+        }
+
+    result = {
+        'guilds': len(guilds),
+        'concurrency': args.concurrency,
+        'before': loop.run_until_complete(run(0, None)),
+        'after': loop.run_until_complete(run(args.spread_window, args.spread_rate)),
+    }
+    _shutdown(loop)
+    return result
+
+
+def meme_selection(args):
+    """get_guild_meme over large guild and global queues."""
+    _, database, _ = _setup(args)
+    from benchmarks.meme_selection import populate, timed
+    started = time.perf_counter()
+    populate(database, args.memes, args.guilds, 10, 20)
+    setup = time.perf_counter() - started
+    return {'memes': args.memes, 'guilds': args.guilds, 'setup_s': setup,
+        'get_guild_meme': timed(database.get_guild_meme, list(range(1, args.guilds + 1)))}
+
+
+def settings_churn(args):
+    """A mix of setting reads and writes, with reschedules when the schedule changes."""
+    B, database, backend = _setup(args)
+    from benchmarks.fake_discord import FakeGuild, install
+    from wednesday_bot import async_database
+    from wednesday_bot.scheduler import Scheduler
+    guilds = [FakeGuild(backend, 1000 + i) for i in range(args.guilds)]
+    _populate_settings(database, guilds)
+    install(B.bot, guilds)
+    loop = B.bot.loop
+    B.bot.scheduler = Scheduler()
+    ops = [(random.choice(guilds).id, random.random()) for _ in range(args.ops)]
+    latencies = []
+
+    async def churn():
+        for guild_id, r in ops:
+            started = time.perf_counter()
+            if r < 0.05:
+                await async_database.set_setting(guild_id, 'time', '%02d:%02d' % (random.randrange(24), random.randrange(60)))
+                await B.reschedule(guild_id)
+            elif r < 0.2:
+                await async_database.set_setting(guild_id, 'mode', random.choice(['Classic', 'Text', 'Variety']))
+            else:
+                await async_database.get_setting(guild_id, random.choice(['mode', 'emoji', 'channel', 'admin_role']))
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    loop.run_until_complete(churn())
+    duration = time.perf_counter() - started
+    latencies.sort()
+    result = {
+        'guilds': len(guilds),
+        'ops': len(ops),
+        'ops_per_s': len(ops) / duration,
+        'p50_ms': 1000 * latencies[len(latencies) // 2],
+        'p99_ms': 1000 * latencies[int(len(latencies) * 0.99)],
+        'cache_hits': database.settings_cache.hits,
+        'cache_misses': database.settings_cache.misses,
+    }
+    _shutdown(loop)
+    return result
+
+
+def verify(args):
+    """The meme verifier against a local image host, then selection skipping what it rejected.
+
+    The host is allowed by address only, so redirects to it by name must be refused, and a verifier
+    without the exception must refuse it outright.
+    """
+    _, database, _ = _setup(args)
+    from benchmarks.fake_images import FakeImageHost
+    from benchmarks.meme_selection import timed
+    from wednesday_bot.verify import MemeVerifier
+    loop = asyncio.get_event_loop()
+    host = FakeImageHost(latency=args.latency, distinct=int(args.verify_memes * 0.9))
+    url = loop.run_until_complete(host.start())
+    kinds = ['image'] * 83 + ['missing'] * 5 + ['page'] * 5 + ['large'] * 5 + ['redirect'] * 2
+    urls = ['%s/%s/%d' % (url, random.choice(kinds), i) for i in range(args.verify_memes)]
+    database.add_global_memes(urls, approved=True)
+    verifier = MemeVerifier(concurrency=args.verify_concurrency, allowed_hosts={'127.0.0.1'})
+    started = time.perf_counter()
+    loop.run_until_complete(verifier.run_once())
+    duration = time.perf_counter() - started
+
+    async def check_public_only():
+        public_only = MemeVerifier()
+        async with public_only.session() as session:
+            return [await public_only.check(session, '%s/%s/0' % (url, kind)) for kind in ('image', 'redirect')]
+
+    requests = host.requests
+    refused = loop.run_until_complete(check_public_only())
+    fetched_loopback = host.requests - requests
+    loop.run_until_complete(host.stop())
+    statuses = dict(database.db.execute('SELECT status, COUNT(*) FROM meme_metadata GROUP BY status').fetchall())
+    duplicates = database.db.execute('SELECT COUNT(*) FROM meme_metadata WHERE duplicate_of IS NOT NULL').fetchone()[0]
+    picked = [database.get_guild_meme(guild_id) for guild_id in range(1, 201)]
+    skipped = database.db.execute('SELECT COUNT(*) FROM meme_metadata WHERE url IN (%s) AND (status<>? OR duplicate_of IS NOT NULL)'
+            % ','.join('?' * len(picked)), picked + ['ok']).fetchone()[0]
+    redirects_followed = database.db.execute("SELECT COUNT(*) FROM meme_metadata WHERE url LIKE '%/redirect/%' AND status<>'broken'").fetchone()[0]
+    if skipped or redirects_followed or fetched_loopback or any(result['status'] != 'broken' for result in refused):
+        raise AssertionError('%d unusable memes selected, %d redirects to localhost followed, %d loopback requests made by a public-only verifier'
+                % (skipped, redirects_followed, fetched_loopback))
+    return {
+        'memes': len(urls),
+        'concurrency': args.verify_concurrency,
+        'duration_s': duration,
+        'urls_per_s': len(urls) / duration,
+        'requests': host.requests,
+        'statuses': statuses,
+        'duplicates': duplicates,
+        'unusable_selected': skipped,
+        'get_guild_meme': timed(database.get_guild_meme, list(range(1, 201))),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS)
+    parser.add_argument('--output')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--guilds', type=int, default=10000)
+    parser.add_argument('--burst-guilds', type=int, default=2000)
+    parser.add_argument('--memes', type=int, default=100000)
+    parser.add_argument('--ops', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--spread-window', type=int, default=10, help='posting window in seconds for the spread scenario')
+    parser.add_argument('--spread-rate', type=float, default=100, help='target sends per second for the spread scenario')
+    parser.add_argument('--verify-memes', type=int, default=2000)
+    parser.add_argument('--verify-concurrency', type=int, default=8)
+    parser.add_argument('--post-rate', type=float, default=0)
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated REST latency in seconds')
+    parser.add_argument('--global-rate', type=int, default=0, help='simulated global rate limit per second')
+    parser.add_argument('--in-process', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.in_process:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.environ['DB_FILE'] = os.path.join(tmp, 'bench.db')
+            result = globals()[args.scenario[0]](args)
+            # flush buffered events before the database is deleted
+            sys.modules['wednesday_bot.database'].flush_events()
+        json.dump(result, sys.stdout)
+        return
+
+    params = {k: v for k, v in vars(args).items() if k not in ('scenario', 'output', 'in_process')}
+    report = {
+        'params': params,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'results': {},
+    }
+    passthrough = [arg for arg in argv if not arg.startswith('--scenario') and arg not in (args.scenario or [])]
+    for name in args.scenario or SCENARIOS:
+        print('running %s' % name, file=sys.stderr)
+        proc = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--in-process', '--scenario', name] + passthrough,
+                stdout=subprocess.PIPE, env=dict(os.environ, LOG_LEVEL='WARNING'), check=True)
+        report['results'][name] = json.loads(proc.stdout.decode().strip().splitlines()[-1])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Import or export meme queues directly against the database.
+
+    python memes.py import FILE [--guild ID | --global] [--format FMT] [--approved] [--submitter ID]
+    python memes.py export [--guild ID | --global] [--format FMT] [-o FILE]
+"""
+from dotenv import load_dotenv
+import argparse
+import os
+import logging
+import sys
+
+
+load_dotenv()
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'),
+        format='%(asctime)s - %(levelname)s - %(name)s: %(message)s')
+
+
+from wednesday_bot import bulk, database
+
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+subparsers = parser.add_subparsers(dest='command', required=True)
+import_parser = subparsers.add_parser('import')
+import_parser.add_argument('file', help='file to read, or - for stdin')
+import_parser.add_argument('--approved', action='store_true', help='mark imported global memes as approved, so they can be posted')
+import_parser.add_argument('--submitter', type=int)
+export_parser = subparsers.add_parser('export')
+export_parser.add_argument('-o', '--output', default='-', help='file to write, or - for stdout')
+for subparser in (import_parser, export_parser):
+    target = subparser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--guild', type=int)
+    target.add_argument('--global', dest='global_queue', action='store_true')
+    subparser.add_argument('--format', choices=bulk.FORMATS)
+args = parser.parse_args()
+
+if args.command == 'import':
+    fmt = args.format or bulk.detect_format(args.file)
+    with (sys.stdin if args.file == '-' else open(args.file, newline='', encoding='utf-8')) as f:
+        urls = bulk.unique_urls(bulk.read_urls(f, fmt))
+    if args.global_queue:
+        added = database.add_global_memes(urls, args.approved, args.submitter)
+    else:
+        added = database.add_guild_memes(args.guild, urls, args.submitter)
+    logging.info('imported %d memes (%d already queued)', added, len(urls) - added)
+else:
+    fmt = args.format or bulk.detect_format(args.output, 'csv')
+    rows = database.iter_global_memes() if args.global_queue else database.iter_guild_memes(args.guild)
+    with (sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')) as f:
+        count = bulk.write_memes(rows, fmt, f)
+    logging.info('exported %d memes', count)
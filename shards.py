@@ -0,0 +1,43 @@
+"""Run the bot as several processes, each connecting a slice of the shards.
+
+SHARD_COUNT sets the total number of shards and SHARD_PROCESSES how many worker processes to split them across.
+If METRICS_PORT is set, each worker serves its metrics on its own port, METRICS_PORT plus its index.
+"""
+from dotenv import load_dotenv
+import os
+import logging
+import signal
+import subprocess
+import sys
+
+
+load_dotenv()
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'),
+        format='%(asctime)s - %(levelname)s - %(name)s: %(message)s')
+
+
+# run migrations once before the workers race to do it
+import wednesday_bot.database
+
+
+shard_count = int(os.environ['SHARD_COUNT'])
+process_count = min(shard_count, int(os.environ.get('SHARD_PROCESSES', os.cpu_count() or 1)))
+workers = []
+for i in range(process_count):
+    shard_ids = ','.join(str(shard_id) for shard_id in range(i, shard_count, process_count))
+    logging.info('starting worker %d with shards %s', i, shard_ids)
+    env = dict(os.environ, SHARD_IDS=shard_ids)
+    if os.environ.get('METRICS_PORT'):
+        env['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + i)
+    workers.append(subprocess.Popen([sys.executable, '-u', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')],
+        env=env))
+
+
+def stop(signum, frame):
+    for worker in workers:
+        worker.send_signal(signum)
+
+
+signal.signal(signal.SIGTERM, stop)
+signal.signal(signal.SIGINT, stop)
+sys.exit(max(worker.wait() for worker in workers))
@@ -0,0 +1,161 @@
+"""Awaitable versions of the database functions.
+
+Writes are serialized on a single writer thread sharing `database.db`, reads run on a small pool
+of threads with their own WAL connections, so disk latency never blocks the event loop.
+"""
+import asyncio
+import datetime
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Optional, Dict, Any, Iterable, List, Tuple
+from . import bulk, database
+
+
+writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer',
+        initializer=database.use_writer_connection)
+readers = ThreadPoolExecutor(max_workers=int(os.environ.get('DB_READERS', '4')), thread_name_prefix='db-reader')
+# long-running snapshots get their own thread so they don't hold up reads
+backups = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-backup')
+
+
+def _run(executor, fn, *args, **kwargs):
+    return asyncio.get_event_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+async def get_settings(guild_id: int) -> Dict[str, Optional[str]]:
+    settings = database.settings_cache.peek(guild_id)
+    if settings is None:
+        settings = await _run(readers, database.settings_cache.get, guild_id)
+    return settings
+
+
+async def get_setting(guild_id: int, key: str, default = None) -> Optional[str]:
+    value = (await get_settings(guild_id)).get(key)
+    return value if value is not None else default
+
+
+async def set_setting(guild_id: int, key: str, value: str):
+    await _run(writer, database.set_setting, guild_id, key, value)
+
+
+async def load_all_settings() -> Dict[int, Dict[str, Optional[str]]]:
+    return await _run(readers, database.load_all_settings)
+
+
+async def get_schedule(guild_id: int, from_dt = None) -> datetime.datetime:
+    await get_settings(guild_id)
+    return database.get_schedule(guild_id, from_dt)
+
+
+async def load_schedule_state() -> Dict[int, Tuple[Optional[datetime.datetime], Optional[datetime.datetime]]]:
+    return await _run(readers, database.load_schedule_state)
+
+
+async def save_schedules(schedules: Iterable[Tuple[int, datetime.datetime]]):
+    await _run(writer, database.save_schedules, list(schedules))
+
+
+async def save_schedule(guild_id: int, next_post: datetime.datetime, last_post: Optional[datetime.datetime] = None):
+    await _run(writer, database.save_schedule, guild_id, next_post, last_post)
+
+
+async def delete_schedule(guild_id: int):
+    await _run(writer, database.delete_schedule, guild_id)
+
+
+async def get_queue_depth(guild_id: int):
+    return await _run(readers, database.get_queue_depth, guild_id)
+
+
+async def get_global_queue_depth(guild_id: int):
+    return await _run(readers, database.get_global_queue_depth, guild_id)
+
+
+async def get_queue_stats(guild_id: int) -> Dict[str, int]:
+    return await _run(readers, database.get_queue_stats, guild_id)
+
+
+async def get_guild_meme(guild_id: int) -> Optional[str]:
+    return await _run(readers, database.get_guild_meme, guild_id)
+
+
+async def mark_guild_meme(guild_id: int, url: str):
+    await _run(writer, database.mark_guild_meme, guild_id, url)
+
+
+async def add_guild_meme(guild_id: int, url: str, submitter: Optional[int] = None):
+    await _run(writer, database.add_guild_meme, guild_id, url, submitter)
+
+
+async def add_global_meme(url: str, approved: Optional[bool] = False, submitter: Optional[int] = None):
+    await _run(writer, database.add_global_meme, url, approved, submitter)
+
+
+async def add_guild_memes(guild_id: int, urls: List[str], submitter: Optional[int] = None) -> int:
+    return await _run(writer, database.add_guild_memes, guild_id, urls, submitter)
+
+
+async def add_global_memes(urls: List[str], approved: Optional[bool] = False, submitter: Optional[int] = None) -> int:
+    return await _run(writer, database.add_global_memes, urls, approved, submitter)
+
+
+async def export_memes(out: IO[str], fmt: str, guild_id: Optional[int] = None) -> int:
+    """Stream a guild's queue, or the global queue if `guild_id` is None, to `out`."""
+    def export():
+        rows = database.iter_global_memes() if guild_id is None else database.iter_guild_memes(guild_id)
+        return bulk.write_memes(rows, fmt, out)
+    return await _run(readers, export)
+
+
+async def get_unverified_memes(limit: int, max_age: datetime.timedelta) -> List[str]:
+    return await _run(readers, database.get_unverified_memes, limit, max_age)
+
+
+async def save_meme_metadata(rows: List[Dict[str, Any]]):
+    await _run(writer, database.save_meme_metadata, rows)
+
+
+async def backup(path: str, compress: bool = False) -> Dict[str, Any]:
+    return await _run(backups, database.backup, path, compress)
+
+
+async def vacuum() -> Dict[str, Any]:
+    return await _run(writer, database.vacuum)
+
+
+async def get_event_count(event: str, day: datetime.date, guild_id: Optional[int] = None) -> int:
+    return await _run(readers, database.get_event_count, event, day, guild_id)
+
+
+async def prune_event_log(before: datetime.datetime, archive_dir: Optional[str] = None) -> int:
+    """Prune old events in small batches so other writes can interleave."""
+    total = 0
+    while True:
+        deleted = await _run(writer, database.prune_event_log, before, archive_dir)
+        if not deleted:
+            return total
+        total += deleted
+
+
+_flush = None
+
+
+def log_event(event: str, payload: Optional[Dict[str, Any]] = None):
+    """Buffer an event, handing a batch to the writer thread once enough have queued up."""
+    if database.log_event(event, payload):
+        flush_events()
+
+
+def flush_events():
+    global _flush
+    if _flush is None or _flush.done():
+        _flush = writer.submit(database.flush_events)
+    return _flush
+
+
+async def run_event_flusher(interval: float = float(os.environ.get('EVENT_FLUSH_INTERVAL', '5'))):
+    while True:
+        await asyncio.sleep(interval)
+        if len(database.event_buffer):
+            await asyncio.wrap_future(flush_events())
@@ -1,17 +1,73 @@
+import asyncio
+import collections
+import dataclasses
 import datetime
 import dateutil.tz
 import discord
 import discord.ext.commands
+import functools
+import io
 import logging
 import os
+import random
+import tempfile
 import traceback
 from sqlite3 import IntegrityError
 from typing import Union
+from . import bulk, metrics
+from .lookup import GuildIndex
+from .payloads import PayloadCache, CLASSIC_URL
+from .permissions import MemberRoleCache, RoleCache, SUPER_ADMIN, has_role
 from .scheduler import Scheduler
-from .database import get_setting, set_setting, get_schedule, add_guild_meme, get_guild_meme, mark_guild_meme, add_global_meme, log_event
+from .verify import MemeVerifier
+from .database import compute_schedule
+from .async_database import get_setting, set_setting, get_schedule, add_guild_meme, get_guild_meme, mark_guild_meme, add_global_meme, log_event, run_event_flusher, prune_event_log, load_all_settings, load_schedule_state, save_schedules, save_schedule, delete_schedule, add_guild_memes, add_global_memes, export_memes, get_queue_stats, backup, vacuum
 
 
-bot = discord.ext.commands.Bot(command_prefix=discord.ext.commands.when_mentioned)
+MAX_WINDOW_MINUTES = 60
+
+if 'SHARD_COUNT' in os.environ:
+    shard_ids = [int(x) for x in os.environ['SHARD_IDS'].split(',')] if os.environ.get('SHARD_IDS') else None
+    bot = discord.ext.commands.AutoShardedBot(command_prefix=discord.ext.commands.when_mentioned,
+            shard_count=int(os.environ['SHARD_COUNT']), shard_ids=shard_ids)
+else:
+    bot = discord.ext.commands.Bot(command_prefix=discord.ext.commands.when_mentioned)
+index = GuildIndex()
+payloads = PayloadCache()
+roles = RoleCache()
+# without the members intent there are no member updates to invalidate it with
+member_roles = MemberRoleCache() if bot.intents.members else None
+verifier = MemeVerifier(concurrency=int(os.environ.get('VERIFY_CONCURRENCY', '8')),
+        max_size=int(os.environ.get('MAX_MEME_SIZE', str(8 << 20))))
+
+post_seconds = metrics.Histogram('wednesday_post_seconds', 'Time taken by do_post, by mode')
+command_seconds = metrics.Histogram('wednesday_command_seconds', 'Command latency, by command')
+batch_latency_seconds = metrics.Histogram('wednesday_batch_latency_seconds',
+        'Worst delay between scheduled and actual completion of a dispatched batch')
+event_loop_lag_seconds = metrics.Histogram('wednesday_event_loop_lag_seconds', 'How long the event loop was blocked')
+rate_limited = metrics.Counter('wednesday_rate_limited', 'HTTP 429 responses from the Discord API')
+metrics.Gauge('wednesday_scheduler_lag_seconds', 'How overdue the earliest scheduled task is',
+        lambda: bot.scheduler.lag if getattr(bot, 'scheduler', None) else 0)
+metrics.Gauge('wednesday_scheduler_pending', 'Scheduled tasks and group members waiting to run',
+        lambda: bot.scheduler.pending if getattr(bot, 'scheduler', None) else 0)
+metrics.Gauge('wednesday_scheduler_heap_size', 'Entries in the scheduler heap, including tombstones',
+        lambda: len(bot.scheduler.heap) if getattr(bot, 'scheduler', None) else 0)
+
+
+class RateLimitCounter(logging.Handler):
+    """Counts the 429s discord.py retries itself, which never reach our code, from the warning it logs for each."""
+
+    def emit(self, record):
+        if str(record.msg).startswith('We are being rate limited'):
+            rate_limited.inc()
+
+
+if metrics.enabled:
+    http_logger = logging.getLogger('discord.http')
+    http_logger.addHandler(RateLimitCounter())
+    if not http_logger.isEnabledFor(logging.WARNING):
+        # the records are only created if the logger is enabled for them
+        http_logger.setLevel(logging.WARNING)
 
 
 def check_guild(ctx):
@@ -19,24 +75,19 @@ def check_guild(ctx):
         raise discord.ext.commands.CommandError('This command may only be used in a channel.')
     return True
 
-def check_guild_admin(ctx):
+async def check_guild_admin(ctx):
     if not ctx.guild:
         raise discord.ext.commands.CommandError('This command may only be used in a channel.')
-    elif ctx.author.id == int(os.environ['DISCORD_SUPER_ADMIN']):
+    elif ctx.author.id == SUPER_ADMIN:
         return True
-    elif ctx.author.guild_permissions.administrator:
+    admin_role_id, _ = await guild_roles(ctx.guild)
+    if has_role(ctx.author, admin_role_id, member_roles) or ctx.author.guild_permissions.administrator:
         return True
+    role = ctx.guild.get_role(admin_role_id)
+    if role is None:
+        raise discord.ext.commands.CommandError('This command may only be used by a server admin.')
     else:
-        role_id = int(get_setting(ctx.guild.id, 'admin_role', '0'))
-        for role in ctx.author.roles:
-            logging.debug(role)
-            if role.id == role_id:
-                return True
-        if role_id == 0:
-            raise discord.ext.commands.CommandError('This command may only be used by a server admin.')
-        else:
-            role = discord.utils.get(ctx.guild.roles, id=role_id)
-            raise discord.ext.commands.CommandError('This command may only be used by ' + role.name)
+        raise discord.ext.commands.CommandError('This command may only be used by ' + role.name)
 
 def check_guild_permissions(ctx):
     if not ctx.guild:
@@ -47,46 +98,106 @@ def check_guild_permissions(ctx):
             return True
         raise discord.ext.commands.CommandError('The bot needs the "manage messages" permission for this command.')
 
-def check_guild_submitter(ctx):
+async def check_guild_submitter(ctx):
     if not ctx.guild:
         raise discord.ext.commands.CommandError('This command may only be used in a channel.')
-    elif ctx.author.id == int(os.environ['DISCORD_SUPER_ADMIN']):
+    elif ctx.author.id == SUPER_ADMIN:
         return True
-    elif ctx.author.guild_permissions.administrator:
+    _, submitter_role_id = await guild_roles(ctx.guild)
+    if has_role(ctx.author, submitter_role_id, member_roles) or ctx.author.guild_permissions.administrator:
         return True
-    else:
-        submitter_role_id = int(get_setting(ctx.guild.id, 'submitter_role', '0'))
-        submitter_role = discord.utils.get(ctx.guild.roles, id=submitter_role_id)
-        if not submitter_role:
-            submitter_role = ctx.guild.default_role
-        for role in ctx.author.roles:
-            logging.debug(role)
-            if role.id == submitter_role.id:
-                return True
-        raise discord.ext.commands.CommandError('This command may only be used by ' + submitter_role.name)
+    raise discord.ext.commands.CommandError('This command may only be used by ' + ctx.guild.get_role(submitter_role_id).name)
 
 def check_super_admin(ctx):
-    return ctx.author.id == int(os.environ['DISCORD_SUPER_ADMIN'])
+    return ctx.author.id == SUPER_ADMIN
+
+async def guild_roles(guild):
+    """Return the guild's (admin role id, submitter role id), loading them from settings on first use."""
+    resolved = roles.get(guild.id)
+    if resolved is None:
+        resolved = roles.set(guild, int(await get_setting(guild.id, 'admin_role', '0')),
+                int(await get_setting(guild.id, 'submitter_role', '0')))
+    return resolved
 
 @bot.event
 async def on_ready():
     logging.info('%s %s', 'Invite: ', generate_invite_link())
-    bot.scheduler = Scheduler()
+    started = bot.loop.time()
+    timings = {}
+    if getattr(bot, 'scheduler', None) is None:
+        bot.scheduler = Scheduler(concurrency=int(os.environ.get('POST_CONCURRENCY', '1')),
+                rate=float(os.environ.get('POST_RATE', '0')) or None, on_batch=log_batch,
+                spread_rate=float(os.environ.get('POST_SPREAD_RATE', '0')) or None)
+        bot.loop.create_task(bot.scheduler.run())
+        bot.loop.create_task(run_event_flusher())
+        bot.loop.create_task(report_shard_health())
+        if metrics.enabled:
+            try:
+                await metrics.serve()
+            except OSError:
+                # metrics are never worth missing posts over
+                logging.exception('failed to serve metrics')
+            bot.loop.create_task(metrics.monitor_event_loop(event_loop_lag_seconds))
+        if is_primary() and os.environ.get('VERIFY_INTERVAL', '3600') != '0':
+            bot.loop.create_task(verifier.run(float(os.environ.get('VERIFY_INTERVAL', '3600'))))
+        if 'EVENT_LOG_RETENTION_DAYS' in os.environ and is_primary():
+            bot.scheduler.reschedule('prune_event_log',
+                    datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(hours=1), prune_events)
+        if 'BACKUP_DIR' in os.environ and is_primary():
+            bot.scheduler.reschedule('backup',
+                    datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(hours=1), scheduled_backup)
+        if 'VACUUM_INTERVAL_DAYS' in os.environ and is_primary():
+            bot.scheduler.reschedule('vacuum', outside_wednesday(datetime.datetime.now(tz=datetime.timezone.utc)
+                    + datetime.timedelta(days=float(os.environ['VACUUM_INTERVAL_DAYS']))), scheduled_vacuum)
     if 'RESUME_TIME' in os.environ:
-        resume_time = datetime.datetime.fromisoformat(os.environ['RESUME_TIME'])
+        # a naive time is local, as it would be to compute_schedule
+        resume_time = datetime.datetime.fromisoformat(os.environ['RESUME_TIME']).astimezone()
     else:
         resume_time = None
     for guild in bot.guilds:
+        index.add_guild(guild)
         log_event('guild_ready', {'guild_id': guild.id, 'name': guild.name, 'description': guild.description,
             'member_count': guild.member_count, 'region': str(guild.region), 'text_channel_count': len(guild.text_channels),
             'voice_channel_count': len(guild.voice_channels)})
-        reschedule(guild.id, resume_time)
-        try:
-            await create_wednesday_emoji(guild)
-        except:
-            traceback.print_exc()
-    bot.loop.create_task(bot.scheduler.run())
-    log_event('start', {'resume_time': resume_time})
+    timings['guild_ready'] = bot.loop.time() - started
+    all_settings = await load_all_settings()
+    timings['load_settings'] = bot.loop.time() - started
+    state = await load_schedule_state()
+    timings['load_schedule_state'] = bot.loop.time() - started
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    catch_up = datetime.timedelta(hours=float(os.environ.get('CATCH_UP_HOURS', '12')))
+    schedules = []
+    missed = 0
+    for guild in bot.guilds:
+        next_post, last_post = state.get(guild.id, (None, None))
+        # persisted times already have the guild's window applied
+        window = 0
+        if resume_time or not next_post or (last_post and last_post >= next_post) or next_post < now - catch_up:
+            settings = all_settings.get(guild.id, {})
+            window = window_seconds(settings.get('window'))
+            from_dt = resume_time or now
+            if last_post:
+                # never repeat a post that already went out, even if RESUME_TIME is from before it
+                from_dt = max(from_dt, last_post + datetime.timedelta(seconds=window + 1))
+            next_post = compute_schedule(settings, from_dt)
+        elif next_post <= now:
+            missed += 1
+        schedules.append((guild.id, next_post, do_post, window))
+    bot.scheduler.join_many(schedules)
+    schedules = [(guild_id, bot.scheduler.members[guild_id].time) for guild_id, *_ in schedules]
+    timings['schedule'] = bot.loop.time() - started
+    await save_schedules(schedules)
+    timings['save_schedules'] = bot.loop.time() - started
+    bot.loop.create_task(create_wednesday_emojis(bot.guilds))
+    log_event('start', {'resume_time': resume_time, 'guild_count': len(bot.guilds), 'missed_posts': missed, 'timings': timings})
+
+@bot.event
+async def on_shard_ready(shard_id):
+    log_event('shard_ready', {'shard_id': shard_id})
+
+@bot.event
+async def on_shard_disconnect(shard_id):
+    log_event('shard_disconnect', {'shard_id': shard_id})
 
 @bot.event
 async def on_guild_join(guild):
@@ -94,16 +205,79 @@ async def on_guild_join(guild):
         'member_count': guild.member_count, 'region': str(guild.region), 'text_channel_count': len(guild.text_channels),
         'voice_channel_count': len(guild.voice_channels)})
     logging.debug(guild)
-    reschedule(guild.id)
+    index.add_guild(guild)
+    await reschedule(guild.id)
     try:
         await create_wednesday_emoji(guild)
     except discord.Forbidden:
         pass
 
+@bot.event
+async def on_guild_available(guild):
+    # a guild that comes back from an outage is a new object, with new channels and emojis
+    index.add_guild(guild)
+
 @bot.event
 async def on_guild_remove(guild):
     log_event('guild_remove', {'guild_id': guild.id})
     logging.debug(guild)
+    index.remove_guild(guild.id)
+    payloads.invalidate(guild.id)
+    roles.invalidate(guild.id)
+    if member_roles:
+        member_roles.invalidate(guild.id)
+    bot.scheduler.leave(guild.id)
+    await delete_schedule(guild.id)
+
+@bot.event
+async def on_guild_channel_create(channel):
+    index.update_channels(channel.guild)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    index.update_channels(channel.guild)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    if before.name != after.name:
+        index.update_channels(after.guild)
+
+@bot.event
+async def on_guild_emojis_update(guild, before, after):
+    index.update_emojis(guild, after)
+    payloads.invalidate(guild.id)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    payloads.invalidate(after.guild.id)
+
+@bot.event
+async def on_guild_role_delete(role):
+    payloads.invalidate(role.guild.id)
+    roles.invalidate(role.guild.id)
+    if member_roles:
+        member_roles.invalidate(role.guild.id)
+
+@bot.event
+async def on_member_update(before, after):
+    if after.id == bot.user.id:
+        payloads.invalidate(after.guild.id)
+    if member_roles:
+        member_roles.invalidate(after.guild.id, after.id)
+
+@bot.event
+async def on_member_remove(member):
+    if member_roles:
+        member_roles.invalidate(member.guild.id, member.id)
+
+@bot.event
+async def on_command(ctx):
+    ctx.started = bot.loop.time()
+
+@bot.event
+async def on_command_completion(ctx):
+    if metrics.enabled:
+        command_seconds.observe(bot.loop.time() - ctx.started, command=ctx.command.name)
 
 @bot.event
 async def on_command_error(ctx, error):
@@ -120,33 +294,41 @@ async def settings(ctx):
         return
     em = discord.Embed(title='Settings')
     em.set_author(name=bot.user.name, icon_url=bot.user.avatar_url)
-    em.add_field(name='Mode', value=get_effective_mode(ctx.guild.id))
-    em.add_field(name='Channel', value=get_setting(ctx.guild.id, 'channel', 'Not set'))
-    ts = get_schedule(ctx.guild.id)
-    em.add_field(name='Schedule', value=ts.strftime('%I:%M %p %Z'))
-    emoji_name = get_setting(ctx.guild.id, 'emoji', 'wednesday')
-    emoji = discord.utils.get(ctx.guild.emojis, name=emoji_name)
-    if not emoji:
-        if emoji_name.encode('utf-8')[0] >= 128:
-            emoji = emoji_name
-        else:
-            emoji = '🐸'
-    em.add_field(name='Emoji', value=emoji)
-    admin_role_id = int(get_setting(ctx.guild.id, 'admin_role', '0'))
-    admin_role = discord.utils.get(ctx.guild.roles, id=admin_role_id)
+    em.add_field(name='Mode', value=await get_effective_mode(ctx.guild.id))
+    channel = await get_post_channel(ctx.guild)
+    em.add_field(name='Channel', value=channel.name if channel else await get_setting(ctx.guild.id, 'channel', 'Not set'))
+    ts = await get_schedule(ctx.guild.id)
+    window = int(await get_setting(ctx.guild.id, 'window', '0'))
+    em.add_field(name='Schedule', value=ts.strftime('%I:%M %p %Z') + (' \u00b1%d min' % window if window else ''))
+    em.add_field(name='Emoji', value=await get_emoji(ctx.guild))
+    admin_role_id, submitter_role_id = await guild_roles(ctx.guild)
+    admin_role = ctx.guild.get_role(admin_role_id)
     if admin_role:
         admin_role_name = admin_role.name
     else:
         admin_role_name = 'admins only'
     em.add_field(name='Admin Role', value=admin_role_name)
-    submitter_role_id = int(get_setting(ctx.guild.id, 'submitter_role', '0'))
-    submitter_role = discord.utils.get(ctx.guild.roles, id=submitter_role_id)
-    if not submitter_role:
-        submitter_role = ctx.guild.default_role
-    em.add_field(name='Submitter Role', value=submitter_role.name)
+    em.add_field(name='Submitter Role', value=ctx.guild.get_role(submitter_role_id).name)
     await ctx.send(embed=em)
     log_event('command_settings_success', {'guild_id': ctx.guild.id})
 
+@bot.command()
+@discord.ext.commands.check(check_guild_admin)
+async def stats(ctx):
+    """Show how many memes are left to post"""
+    log_event('command_stats', {'guild_id': ctx.guild.id})
+    counts = await get_queue_stats(ctx.guild.id)
+    lines = [
+        'Server memes queued: %d' % counts['unposted'],
+        'Server memes posted: %d' % counts['posted'],
+        'Global memes not yet posted here: %d' % counts['global_unposted'],
+    ]
+    group = bot.scheduler.members.get(ctx.guild.id)
+    if group:
+        lines.append('Next post: ' + group.time.strftime('%Y-%m-%d %I:%M %p %Z'))
+    await ctx.send('\n'.join(lines))
+    log_event('command_stats_success', {'guild_id': ctx.guild.id})
+
 @bot.command()
 @discord.ext.commands.check(check_guild_admin)
 async def schedule(ctx, time: str, timezone: str = None):
@@ -157,13 +339,13 @@ async def schedule(ctx, time: str, timezone: str = None):
         if not tz:
             await ctx.send('Unknown timezone')
             raise ValueError('unknown timezone')
-        set_setting(ctx.guild.id, 'timezone', timezone)
+        await set_setting(ctx.guild.id, 'timezone', timezone)
     parsed_time = datetime.time.fromisoformat(time)
-    set_setting(ctx.guild.id, 'time', time)
-    ts = get_schedule(ctx.guild.id)
+    await set_setting(ctx.guild.id, 'time', time)
+    ts = await get_schedule(ctx.guild.id)
     logging.debug(ts)
     await ctx.send('Schedule set to ' + ts.strftime('%I:%M %p %Z'))
-    reschedule(ctx.guild.id)
+    await reschedule(ctx.guild.id)
     log_event('command_schedule_success', {'guild_id': ctx.guild.id})
 
 @schedule.error
@@ -172,12 +354,25 @@ async def schedule_error(ctx, error):
     logging.warning(error)
     await ctx.send('Usage: schedule HH:MM [timezone]')
 
+@bot.command()
+@discord.ext.commands.check(check_guild_admin)
+async def window(ctx, minutes: int):
+    """Let posts go out up to this many minutes either side of the schedule"""
+    log_event('command_window', {'guild_id': ctx.guild.id})
+    if not 0 <= minutes <= MAX_WINDOW_MINUTES:
+        raise discord.ext.commands.CommandError('The window must be between 0 and %d minutes.' % MAX_WINDOW_MINUTES)
+    await set_setting(ctx.guild.id, 'window', minutes)
+    await reschedule(ctx.guild.id)
+    await ctx.send('Posting window set to \u00b1%d minutes' % minutes if minutes else 'Posting window disabled')
+    log_event('command_window_success', {'guild_id': ctx.guild.id, 'minutes': minutes})
+
 @bot.command()
 @discord.ext.commands.check(check_guild_admin)
 async def channel(ctx, channel: discord.TextChannel):
     """Set channel to post in"""
     log_event('command_channel', {'guild_id': ctx.guild.id})
-    set_setting(ctx.guild.id, 'channel', channel.name)
+    await set_setting(ctx.guild.id, 'channel', channel.name)
+    await set_setting(ctx.guild.id, 'channel_id', channel.id)
     await ctx.send('Channel set to ' + channel.mention)
     log_event('command_channel_success', {'guild_id': ctx.guild.id, 'channel': channel.name})
 
@@ -188,9 +383,10 @@ async def emoji(ctx, emoji: Union[discord.Emoji, str]):
     log_event('command_emoji', {'guild_id': ctx.guild.id})
     logging.debug(emoji)
     if isinstance(emoji, discord.Emoji):
-        set_setting(ctx.guild.id, 'emoji', emoji.name)
+        await set_setting(ctx.guild.id, 'emoji', emoji.name)
     else:
-        set_setting(ctx.guild.id, 'emoji', emoji)
+        await set_setting(ctx.guild.id, 'emoji', emoji)
+    payloads.invalidate(ctx.guild.id)
     await ctx.send('Emoji set to ' + str(emoji))
     log_event('command_emoji_success', {'guild_id': ctx.guild.id, 'emoji': str(emoji)})
 
@@ -204,16 +400,17 @@ async def mode(ctx, mode: str):
         return
     logging.debug(mode)
     if mode.lower() == 'classic':
-        set_setting(ctx.guild.id, 'mode', 'Classic')
+        await set_setting(ctx.guild.id, 'mode', 'Classic')
         await ctx.send('Mode set to Classic')
     elif mode.lower() == 'variety':
-        set_setting(ctx.guild.id, 'mode', 'Variety')
+        await set_setting(ctx.guild.id, 'mode', 'Variety')
         await ctx.send('Mode set to Variety')
     elif mode.lower() == 'text':
-        set_setting(ctx.guild.id, 'mode', 'Text')
+        await set_setting(ctx.guild.id, 'mode', 'Text')
         await ctx.send('Mode set to Text')
     else:
         await ctx.send('Unknown mode.\nUsage: mode classic|variety|text')
+    payloads.invalidate(ctx.guild.id)
     log_event('command_mode_success', {'guild_id': ctx.guild.id, 'mode': mode})
 
 @bot.command()
@@ -221,7 +418,8 @@ async def mode(ctx, mode: str):
 async def admin_role(ctx, role: discord.Role):
     """Set admin role"""
     log_event('command_admin_role', {'guild_id': ctx.guild.id})
-    set_setting(ctx.guild.id, 'admin_role', role.id)
+    await set_setting(ctx.guild.id, 'admin_role', role.id)
+    roles.invalidate(ctx.guild.id)
     await ctx.send('Admin role set to ' + role.name)
     log_event('command_admin_role_success', {'guild_id': ctx.guild.id, 'role': role.name})
 
@@ -230,7 +428,8 @@ async def admin_role(ctx, role: discord.Role):
 async def submitter_role(ctx, role: discord.Role):
     """Set submitter role"""
     log_event('command_submitter_role', {'guild_id': ctx.guild.id})
-    set_setting(ctx.guild.id, 'submitter_role', role.id)
+    await set_setting(ctx.guild.id, 'submitter_role', role.id)
+    roles.invalidate(ctx.guild.id)
     await ctx.send('Submitter role set to ' + role.name)
     log_event('command_submitter_role_success', {'guild_id': ctx.guild.id, 'role': role.name})
 
@@ -248,7 +447,8 @@ async def submit(ctx, url):
     log_event('command_submit', {'guild_id': ctx.guild.id})
     await ctx.message.delete()
     try:
-        add_guild_meme(ctx.guild.id, url, ctx.author.id)
+        await add_guild_meme(ctx.guild.id, url, ctx.author.id)
+        verifier.wake()
         await ctx.send('*' + ctx.author.name + ' submitted a meme.*')
     except IntegrityError:
         await ctx.send(ctx.author.mention + ' I already have that meme.')
@@ -259,81 +459,260 @@ async def submit(ctx, url):
 async def add_global(ctx, url):
     log_event('command_add_global')
     try:
-        add_global_meme(url, approved=True, submitter=ctx.author.id)
+        await add_global_meme(url, approved=True, submitter=ctx.author.id)
+        verifier.wake()
         await ctx.send('Accepted')
     except IntegrityError:
         await ctx.send('I already have that meme.')
 
+@bot.command(name='import')
+@discord.ext.commands.check(check_guild_admin)
+async def import_queue(ctx, *urls):
+    """Import memes from URLs or an attached txt, csv or jsonl file"""
+    log_event('command_import', {'guild_id': ctx.guild.id})
+    urls = await read_submitted_urls(ctx, urls)
+    added = await add_guild_memes(ctx.guild.id, urls, ctx.author.id)
+    verifier.wake()
+    await ctx.send('Imported %d memes (%d already queued).' % (added, len(urls) - added))
+    log_event('command_import_success', {'guild_id': ctx.guild.id, 'count': added})
+
+@bot.command(name='export')
+@discord.ext.commands.check(check_guild_admin)
+async def export_queue(ctx, fmt: str = 'csv'):
+    """Export this server's meme queue as csv, jsonl or txt"""
+    log_event('command_export', {'guild_id': ctx.guild.id})
+    await send_export(ctx, fmt, ctx.guild.id)
+    log_event('command_export_success', {'guild_id': ctx.guild.id})
+
+@bot.command()
+@discord.ext.commands.check(check_super_admin)
+async def import_global(ctx, *urls):
+    log_event('command_import_global')
+    urls = await read_submitted_urls(ctx, urls)
+    added = await add_global_memes(urls, approved=True, submitter=ctx.author.id)
+    verifier.wake()
+    await ctx.send('Imported %d memes (%d already queued).' % (added, len(urls) - added))
+    log_event('command_import_global_success', {'count': added})
+
+@bot.command()
+@discord.ext.commands.check(check_super_admin)
+async def export_global(ctx, fmt: str = 'csv'):
+    log_event('command_export_global')
+    await send_export(ctx, fmt, None)
+
+async def read_submitted_urls(ctx, urls):
+    urls = list(urls)
+    for attachment in ctx.message.attachments:
+        text = (await attachment.read()).decode('utf-8')
+        urls.extend(bulk.read_urls(text.splitlines(), bulk.detect_format(attachment.filename)))
+    return bulk.unique_urls(urls)
+
+async def send_export(ctx, fmt, guild_id):
+    if fmt not in bulk.FORMATS:
+        raise discord.ext.commands.CommandError('Format must be one of ' + ', '.join(bulk.FORMATS))
+    with tempfile.SpooledTemporaryFile(max_size=1 << 20) as raw:
+        out = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+        count = await export_memes(out, fmt, guild_id)
+        out.flush()
+        raw.seek(0)
+        await ctx.send('%d memes' % count, file=discord.File(raw, filename='memes.' + fmt))
+        out.detach()
+
+@bot.command(name='backup')
+@discord.ext.commands.check(check_super_admin)
+async def backup_now(ctx):
+    if 'BACKUP_DIR' not in os.environ:
+        raise discord.ext.commands.CommandError('Set BACKUP_DIR to enable backups.')
+    result = await snapshot()
+    await ctx.send('Saved %s (%.1f MB from a %.1f MB database) in %.1fs' % (os.path.basename(result['path']),
+        result['size'] / 1e6, result['db_size'] / 1e6, result['duration']))
+
+@bot.command()
+@discord.ext.commands.check(check_super_admin)
+async def shards(ctx):
+    log_event('command_shards')
+    await ctx.send('\n'.join('Shard {shard_id}: {latency_ms:.0f} ms, {guild_count} guilds'.format(**shard)
+        for shard in shard_status()))
+
 @bot.command()
 @discord.ext.commands.check(check_guild_admin)
 async def test_post(ctx):
     log_event('command_test_post', {'guild_id': ctx.guild.id})
-    chan_name = get_setting(ctx.guild.id, 'channel')
+    chan_name = await get_setting(ctx.guild.id, 'channel')
     if not chan_name:
         await ctx.send('No channel is set.')
         return
-    channel = discord.utils.get(ctx.guild.channels, name=chan_name)
+    channel = await get_post_channel(ctx.guild)
     if not channel:
         await ctx.send('Channel ' + chan_name + ' not found.')
         return
     await do_post(ctx.guild.id)
     log_event('command_test_post_success', {'guild_id': ctx.guild.id})
 
-async def do_post(guild_id):
+async def do_post(guild_id, scheduled=None):
     log_event('do_post', {'guild_id': guild_id})
-    guild = discord.utils.get(bot.guilds, id=guild_id)
-    emoji_name = get_setting(guild_id, 'emoji', 'wednesday')
-    emoji = discord.utils.get(guild.emojis, name=emoji_name)
-    if not emoji:
-        if emoji_name.encode('utf-8')[0] >= 128:
-            emoji = emoji_name
-        else:
-            emoji = '🐸'
-    chan_name = get_setting(guild_id, 'channel')
+    started = bot.loop.time()
+    guild = bot.get_guild(guild_id)
+    resolved = payloads.get(guild_id)
+    if resolved is None:
+        resolved = payloads.set(guild_id, await get_emoji(guild), await get_effective_mode(guild_id))
+    emoji, mode = resolved
+    chan_name = await get_setting(guild_id, 'channel')
     if not chan_name:
         logging.warning('No channel is set.')
-        reschedule(guild_id)
+        await reschedule(guild_id, handled=scheduled)
         return
-    channel = discord.utils.get(guild.channels, name=chan_name)
+    channel = await get_post_channel(guild)
     if not channel:
         logging.warning('Channel ' + chan_name + ' not found.')
-        reschedule(guild_id)
+        await reschedule(guild_id, handled=scheduled)
         return
-    mode = get_effective_mode(guild_id)
     if mode == 'Classic':
-        embed = discord.Embed()
-        embed.set_image(url='https://i.kym-cdn.com/photos/images/original/001/091/264/665.jpg')
-        msg = await channel.send(embed=embed)
+        msg = await with_retry(channel.send, embed=payloads.classic_embed)
         try:
-            await msg.add_reaction(emoji)
+            await with_retry(msg.add_reaction, emoji)
         except discord.Forbidden:
             pass
     elif mode == 'Text':
-        msg = await channel.send(str(emoji) + ' It is Wednesday, my dudes.')
+        msg = await with_retry(channel.send, payloads.text(emoji))
         try:
-            await msg.add_reaction(emoji)
+            await with_retry(msg.add_reaction, emoji)
         except discord.Forbidden:
             pass
     elif mode == 'Variety':
-        url = get_guild_meme(guild_id)
+        url = await get_guild_meme(guild_id)
         if not url:
-            url = 'https://i.kym-cdn.com/photos/images/original/001/091/264/665.jpg'
-        embed = discord.Embed()
-        embed.set_image(url=url)
-        msg = await channel.send(embed=embed)
+            url = CLASSIC_URL
+        msg = await with_retry(channel.send, embed=payloads.variety_embed(url))
         try:
-            await msg.add_reaction(emoji)
+            await with_retry(msg.add_reaction, emoji)
         except discord.Forbidden:
             pass
-        mark_guild_meme(guild_id, url)
-    reschedule(guild_id)
+        await mark_guild_meme(guild_id, url)
+    await reschedule(guild_id, last_post=scheduled)
+    if metrics.enabled:
+        post_seconds.observe(bot.loop.time() - started, mode=mode)
     log_event('do_post_success', {'guild_id': guild_id, 'mode': mode, 'channel': chan_name, 'emoji': emoji})
 
-def reschedule(guild_id, from_dt = None):
-    logging.debug(bot.scheduler.heap)
-    bot.scheduler.heap = [x for x in bot.scheduler.heap if x.args != (guild_id,)]
-    logging.debug(bot.scheduler.heap)
-    bot.scheduler.schedule(get_schedule(guild_id, from_dt), do_post, guild_id)
+async def with_retry(fn, *args, **kwargs):
+    """Back off and retry a request discord.py gave up on after retrying its 429s itself."""
+    retries = int(os.environ.get('POST_RETRIES', '3'))
+    for attempt in range(retries + 1):
+        try:
+            return await fn(*args, **kwargs)
+        except discord.HTTPException as e:
+            if e.status == 429 and not e.response.headers.get('Via'):
+                # a Cloudflare ban rather than a Discord rate limit, which retrying only prolongs
+                rate_limited.inc()
+                raise
+            if e.status != 429 or attempt == retries:
+                raise
+            retry_after = float(e.response.headers.get('Retry-After', 0))
+            delay = max(retry_after, 2 ** attempt) + random.random()
+            log_event('rate_limited', {'attempt': attempt, 'delay': delay})
+            await asyncio.sleep(delay)
+
+def background(fn):
+    """Make a scheduled job start `fn` as a task, so posts due while it runs aren't held up behind it."""
+    @functools.wraps(fn)
+    def start():
+        bot.loop.create_task(fn())
+    return start
+
+@background
+async def prune_events():
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    try:
+        before = now - datetime.timedelta(days=int(os.environ['EVENT_LOG_RETENTION_DAYS']))
+        deleted = await prune_event_log(before, os.environ.get('EVENT_LOG_ARCHIVE_DIR'))
+        log_event('prune_event_log', {'before': before, 'deleted': deleted})
+    except Exception as e:
+        logging.exception('failed to prune the event log')
+        log_event('prune_event_log_error', {'error': str(e)})
+    finally:
+        bot.scheduler.reschedule('prune_event_log', now + datetime.timedelta(days=1), prune_events)
+
+async def snapshot():
+    """Back up the database into BACKUP_DIR, keeping the newest BACKUP_KEEP snapshots."""
+    backup_dir = os.environ['BACKUP_DIR']
+    os.makedirs(backup_dir, exist_ok=True)
+    compress = os.environ.get('BACKUP_COMPRESS', '1') != '0'
+    name = datetime.datetime.now(tz=datetime.timezone.utc).strftime('wednesday-bot-%Y%m%dT%H%M%SZ.db')
+    result = await backup(os.path.join(backup_dir, name + '.gz' if compress else name), compress)
+    snapshots = sorted(f for f in os.listdir(backup_dir) if f.startswith('wednesday-bot-') and f.endswith(('.db', '.db.gz')))
+    for old in snapshots[:-int(os.environ.get('BACKUP_KEEP', '7'))]:
+        os.remove(os.path.join(backup_dir, old))
+    log_event('backup', result)
+    return result
+
+@background
+async def scheduled_backup():
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    try:
+        await snapshot()
+    except Exception as e:
+        logging.exception('backup failed')
+        log_event('backup_error', {'error': str(e)})
+    finally:
+        bot.scheduler.reschedule('backup', now + datetime.timedelta(hours=float(os.environ.get('BACKUP_INTERVAL_HOURS', '24'))),
+                scheduled_backup)
+
+@background
+async def scheduled_vacuum():
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    try:
+        log_event('vacuum', await vacuum())
+    except Exception as e:
+        logging.exception('vacuum failed')
+        log_event('vacuum_error', {'error': str(e)})
+    finally:
+        bot.scheduler.reschedule('vacuum', outside_wednesday(now + datetime.timedelta(days=float(os.environ['VACUUM_INTERVAL_DAYS']))),
+                scheduled_vacuum)
+
+def outside_wednesday(ts):
+    """Move `ts` past the span in which it is Wednesday somewhere (Tuesday 10:00 to Thursday 12:00 UTC)."""
+    ts = ts.astimezone(datetime.timezone.utc)
+    start = datetime.datetime.combine(ts.date() - datetime.timedelta(days=(ts.weekday() - 1) % 7), datetime.time(10),
+            tzinfo=datetime.timezone.utc)
+    end = start + datetime.timedelta(days=2, hours=2)
+    return end if start <= ts < end else ts
+
+def is_primary():
+    """Whether this process runs shard 0, and so owns jobs that must only run once across all shards."""
+    return 0 in (getattr(bot, 'shard_ids', None) or [0])
+
+def shard_status():
+    guild_counts = collections.Counter(guild.shard_id or 0 for guild in bot.guilds)
+    latencies = getattr(bot, 'latencies', [(0, bot.latency)])
+    return [{'shard_id': shard_id, 'latency_ms': latency * 1000, 'guild_count': guild_counts[shard_id]}
+        for shard_id, latency in latencies]
+
+async def report_shard_health():
+    interval = float(os.environ.get('SHARD_HEALTH_INTERVAL', '60'))
+    while True:
+        await asyncio.sleep(interval)
+        log_event('shard_health', {'shards': shard_status(), 'scheduler_lag': bot.scheduler.lag,
+            'scheduler_pending': bot.scheduler.pending})
+
+def log_batch(stats):
+    log_event('scheduler_batch', dataclasses.asdict(stats))
+    if metrics.enabled:
+        batch_latency_seconds.observe(stats.end_latency_max)
+
+async def reschedule(guild_id, from_dt = None, last_post = None, handled = None):
+    """Schedule the guild's next post. `handled` is the time of the post that was just due, if any;
+    `last_post` is the same time when that post actually went out, and is saved as the last post."""
+    window = window_seconds(await get_setting(guild_id, 'window'))
+    handled = handled or last_post
+    if from_dt is None and handled is not None:
+        # the post that was due may have gone out up to `window` before its nominal time, so skip past it
+        from_dt = handled + datetime.timedelta(seconds=window + 1)
+    ts = await get_schedule(guild_id, from_dt)
+    ts = bot.scheduler.join(guild_id, ts, do_post, window).time
+    await save_schedule(guild_id, ts, last_post)
+
+def window_seconds(minutes):
+    return 60 * min(int(minutes or 0), MAX_WINDOW_MINUTES)
 
 def generate_invite_link():
     perms = discord.Permissions()
@@ -344,19 +723,59 @@ def generate_invite_link():
     perms.manage_messages = True
     return discord.utils.oauth_url(os.environ['DISCORD_CLIENT_ID'], perms)
 
+async def create_wednesday_emojis(guilds):
+    started = bot.loop.time()
+    semaphore = asyncio.Semaphore(int(os.environ.get('EMOJI_CONCURRENCY', '4')))
+    async def create(guild):
+        async with semaphore:
+            try:
+                await create_wednesday_emoji(guild)
+            except:
+                traceback.print_exc()
+    await asyncio.gather(*(create(guild) for guild in guilds))
+    log_event('start_emoji', {'guild_count': len(guilds), 'duration': bot.loop.time() - started})
+
+@functools.lru_cache()
+def wednesday_image():
+    with open(os.path.join(os.path.dirname(__file__), 'wednesday.png'), 'rb') as f:
+        return f.read()
+
 async def create_wednesday_emoji(guild):
-    emoji = discord.utils.get(guild.emojis, name='wednesday')
+    emoji = index.emoji(guild, 'wednesday')
     if emoji:
         return
     log_event('create_wednesday_emoji', {'guild_id': guild.id})
-    with open(os.path.join(os.path.dirname(__file__), 'wednesday.png'), 'rb') as f:
-        image = f.read()
-    await guild.create_custom_emoji(name='wednesday', image=image)
+    await guild.create_custom_emoji(name='wednesday', image=wednesday_image())
     log_event('create_wednesday_emoji_success', {'guild_id': guild.id})
 
-def get_effective_mode(guild_id):
-    guild = discord.utils.get(bot.guilds, id=guild_id)
+async def get_post_channel(guild):
+    channel_id = await get_setting(guild.id, 'channel_id')
+    if channel_id:
+        channel = guild.get_channel(int(channel_id))
+        if channel:
+            return channel
+    chan_name = await get_setting(guild.id, 'channel')
+    if not chan_name:
+        return None
+    channel = index.channel(guild, chan_name)
+    if channel:
+        # remember the id so the setting survives a rename
+        await set_setting(guild.id, 'channel_id', channel.id)
+    return channel
+
+async def get_emoji(guild):
+    emoji_name = await get_setting(guild.id, 'emoji', 'wednesday')
+    emoji = index.emoji(guild, emoji_name)
+    if not emoji:
+        if emoji_name.encode('utf-8')[0] >= 128:
+            emoji = emoji_name
+        else:
+            emoji = '🐸'
+    return emoji
+
+async def get_effective_mode(guild_id):
+    guild = bot.get_guild(guild_id)
     if not guild.me.guild_permissions.embed_links:
         return 'Text'
     else:
-        return get_setting(guild_id, 'mode', 'Classic')
+        return await get_setting(guild_id, 'mode', 'Classic')
@@ -0,0 +1,85 @@
+"""Reading and writing meme URL lists for bulk import and export.
+
+Supported formats are plain text (one URL per line), CSV (a `url` column, or the first column) and
+JSONL (objects with a `url` key, or bare strings).
+"""
+import csv
+import json
+import os
+import urllib.parse
+from typing import IO, Iterable, Iterator, List, Optional
+
+
+FORMATS = ('txt', 'csv', 'jsonl')
+
+
+def detect_format(filename: str, default: str = 'txt') -> str:
+    ext = os.path.splitext(filename)[1].lower().lstrip('.')
+    if ext == 'json':
+        ext = 'jsonl'
+    return ext if ext in FORMATS else default
+
+
+def normalize_url(url: str) -> Optional[str]:
+    """Canonicalize a URL for deduplication, or return None if it isn't an http(s) URL."""
+    parts = urllib.parse.urlsplit(url.strip())
+    if parts.scheme.lower() not in ('http', 'https') or not parts.netloc:
+        return None
+    return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+
+def read_urls(lines: Iterable[str], fmt: str) -> Iterator[str]:
+    if fmt == 'csv':
+        rows = csv.reader(lines)
+        column = 0
+        for i, row in enumerate(rows):
+            if not row:
+                continue
+            if i == 0 and 'url' in row:
+                column = row.index('url')
+                continue
+            if column < len(row):
+                yield row[column]
+    elif fmt == 'jsonl':
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            value = json.loads(line)
+            yield value['url'] if isinstance(value, dict) else value
+    else:
+        for line in lines:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def unique_urls(urls: Iterable[str]) -> List[str]:
+    """Normalize and deduplicate URLs, dropping invalid ones and keeping the first occurrence's order."""
+    seen = set()
+    result = []
+    for url in urls:
+        url = normalize_url(url)
+        if url and url not in seen:
+            seen.add(url)
+            result.append(url)
+    return result
+
+
+def write_memes(rows: Iterable, fmt: str, out: IO[str]) -> int:
+    """Stream rows with `url`, `submitter` and `last_posted` or `approved` fields to `out`."""
+    count = 0
+    writer = None
+    for row in rows:
+        row = dict(row)
+        if fmt == 'csv':
+            if writer is None:
+                writer = csv.DictWriter(out, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
+        elif fmt == 'jsonl':
+            out.write(json.dumps(row) + '\n')
+        else:
+            out.write(row['url'] + '\n')
+        count += 1
+    return count
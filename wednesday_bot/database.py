@@ -1,15 +1,48 @@
+import atexit
 import datetime
 import dateutil.tz
+import functools
+import gzip
 import logging
 import json
 import sqlite3
 import os
-from typing import Optional, Dict, Any
+import random
+import shutil
+import threading
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, Iterable, Iterator, List, Tuple
+from . import metrics
 
 
 DB_FILE = os.environ['DB_FILE']
-db = sqlite3.connect(DB_FILE)
-db.row_factory = sqlite3.Row
+db_seconds = metrics.Histogram('wednesday_db_seconds', 'Time spent in database functions, including commits')
+
+
+def connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_FILE, timeout=float(os.environ.get('DB_BUSY_TIMEOUT', '30')), check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+db = connect()
+_local = threading.local()
+
+
+def _db() -> sqlite3.Connection:
+    conn = getattr(_local, 'db', None)
+    if conn is None:
+        conn = _local.db = connect()
+    return conn
+
+
+def use_writer_connection():
+    """Make the calling thread share the module-level writer connection."""
+    _local.db = db
 
 
 def _update_schema(db):
@@ -76,73 +109,580 @@ PRAGMA user_version=4;
         """)
         db.commit()
         user_version = 4
+    if user_version < 5:
+        db.executescript("""
+CREATE INDEX event_log_timestamp ON event_log (timestamp);
+CREATE INDEX event_log_event ON event_log (event, timestamp);
+CREATE TABLE event_rollup (
+    day DATE NOT NULL,
+    event TEXT NOT NULL,
+    guild_id BIGINT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, event, guild_id)
+);
+INSERT INTO event_rollup (day, event, guild_id, count)
+    SELECT date(timestamp), event, COALESCE(json_extract(payload, '$.guild_id'), 0), COUNT(*)
+    FROM event_log GROUP BY 1, 2, 3;
+PRAGMA user_version=5;
+        """)
+        db.commit()
+        user_version = 5
+    if user_version < 6:
+        db.executescript("""
+CREATE INDEX guild_memes_unposted ON guild_memes (guild_id, last_posted);
+ALTER TABLE global_memes ADD COLUMN shuffle_key INTEGER;
+UPDATE global_memes SET shuffle_key=random();
+CREATE INDEX global_memes_shuffle_key ON global_memes (shuffle_key);
+CREATE TABLE global_meme_cursor (
+    guild_id BIGINT NOT NULL PRIMARY KEY,
+    shuffle_key INTEGER NOT NULL
+);
+PRAGMA user_version=6;
+        """)
+        db.commit()
+        user_version = 6
+    if user_version < 7:
+        db.executescript("""
+CREATE TABLE scheduled_posts (
+    guild_id BIGINT NOT NULL PRIMARY KEY,
+    next_post DATETIME,
+    last_post DATETIME
+);
+PRAGMA user_version=7;
+        """)
+        db.commit()
+        user_version = 7
+    if user_version < 8:
+        db.executescript("""
+CREATE INDEX guild_memes_url ON guild_memes (url);
+CREATE TABLE guild_queue_stats (
+    guild_id BIGINT NOT NULL PRIMARY KEY,
+    unposted INTEGER NOT NULL DEFAULT 0,
+    posted INTEGER NOT NULL DEFAULT 0,
+    posted_global INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE global_queue_stats (
+    id INTEGER NOT NULL PRIMARY KEY CHECK (id = 0),
+    approved INTEGER NOT NULL DEFAULT 0
+);
+INSERT INTO guild_queue_stats (guild_id, unposted, posted, posted_global)
+    SELECT guild_id, SUM(last_posted IS NULL), SUM(last_posted IS NOT NULL),
+        SUM(last_posted IS NOT NULL AND EXISTS (SELECT 1 FROM global_memes WHERE url=guild_memes.url AND approved))
+    FROM guild_memes GROUP BY guild_id;
+INSERT INTO global_queue_stats (id, approved) SELECT 0, COUNT(*) FROM global_memes WHERE approved;
+
+CREATE TRIGGER guild_memes_insert AFTER INSERT ON guild_memes BEGIN
+    INSERT OR IGNORE INTO guild_queue_stats (guild_id) VALUES (NEW.guild_id);
+    UPDATE guild_queue_stats SET unposted=unposted+(NEW.last_posted IS NULL), posted=posted+(NEW.last_posted IS NOT NULL),
+        posted_global=posted_global+(NEW.last_posted IS NOT NULL AND EXISTS (SELECT 1 FROM global_memes WHERE url=NEW.url AND approved))
+        WHERE guild_id=NEW.guild_id;
+END;
+CREATE TRIGGER guild_memes_delete AFTER DELETE ON guild_memes BEGIN
+    UPDATE guild_queue_stats SET unposted=unposted-(OLD.last_posted IS NULL), posted=posted-(OLD.last_posted IS NOT NULL),
+        posted_global=posted_global-(OLD.last_posted IS NOT NULL AND EXISTS (SELECT 1 FROM global_memes WHERE url=OLD.url AND approved))
+        WHERE guild_id=OLD.guild_id;
+END;
+CREATE TRIGGER guild_memes_update AFTER UPDATE OF guild_id, url, last_posted ON guild_memes BEGIN
+    UPDATE guild_queue_stats SET unposted=unposted-(OLD.last_posted IS NULL), posted=posted-(OLD.last_posted IS NOT NULL),
+        posted_global=posted_global-(OLD.last_posted IS NOT NULL AND EXISTS (SELECT 1 FROM global_memes WHERE url=OLD.url AND approved))
+        WHERE guild_id=OLD.guild_id;
+    INSERT OR IGNORE INTO guild_queue_stats (guild_id) VALUES (NEW.guild_id);
+    UPDATE guild_queue_stats SET unposted=unposted+(NEW.last_posted IS NULL), posted=posted+(NEW.last_posted IS NOT NULL),
+        posted_global=posted_global+(NEW.last_posted IS NOT NULL AND EXISTS (SELECT 1 FROM global_memes WHERE url=NEW.url AND approved))
+        WHERE guild_id=NEW.guild_id;
+END;
+CREATE TRIGGER global_memes_insert AFTER INSERT ON global_memes WHEN NEW.approved BEGIN
+    UPDATE global_queue_stats SET approved=approved+1;
+    UPDATE guild_queue_stats SET posted_global=posted_global+1
+        WHERE guild_id IN (SELECT guild_id FROM guild_memes WHERE url=NEW.url AND last_posted IS NOT NULL);
+END;
+CREATE TRIGGER global_memes_delete AFTER DELETE ON global_memes WHEN OLD.approved BEGIN
+    UPDATE global_queue_stats SET approved=approved-1;
+    UPDATE guild_queue_stats SET posted_global=posted_global-1
+        WHERE guild_id IN (SELECT guild_id FROM guild_memes WHERE url=OLD.url AND last_posted IS NOT NULL);
+END;
+CREATE TRIGGER global_memes_update AFTER UPDATE OF url, approved ON global_memes BEGIN
+    UPDATE global_queue_stats SET approved=approved-(OLD.approved<>0)+(NEW.approved<>0);
+    UPDATE guild_queue_stats SET posted_global=posted_global-1
+        WHERE OLD.approved AND guild_id IN (SELECT guild_id FROM guild_memes WHERE url=OLD.url AND last_posted IS NOT NULL);
+    UPDATE guild_queue_stats SET posted_global=posted_global+1
+        WHERE NEW.approved AND guild_id IN (SELECT guild_id FROM guild_memes WHERE url=NEW.url AND last_posted IS NOT NULL);
+END;
+PRAGMA user_version=8;
+        """)
+        db.commit()
+        user_version = 8
+    if user_version < 9:
+        db.executescript("""
+CREATE TABLE meme_metadata (
+    url TEXT NOT NULL PRIMARY KEY,
+    status TEXT NOT NULL,
+    content_type TEXT,
+    size INTEGER,
+    hash TEXT,
+    duplicate_of TEXT,
+    last_verified DATETIME NOT NULL
+);
+CREATE INDEX meme_metadata_hash ON meme_metadata (hash);
+PRAGMA user_version=9;
+        """)
+        db.commit()
+        user_version = 9
 
 
 _update_schema(db)
 
 
+class SettingsCache:
+    """Write-through LRU cache of guild settings, loading each guild with a single query."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.guilds = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def peek(self, guild_id: int) -> Optional[Dict[str, Optional[str]]]:
+        with self.lock:
+            settings = self.guilds.get(guild_id)
+            if settings is not None:
+                self.hits += 1
+                self.guilds.move_to_end(guild_id)
+            return settings
+
+    def get(self, guild_id: int) -> Dict[str, Optional[str]]:
+        settings = self.peek(guild_id)
+        if settings is not None:
+            return settings
+        with self.lock:
+            self.misses += 1
+            writes = self.writes
+        cur = _db().execute('SELECT key, value FROM guild_settings WHERE guild_id=?', (guild_id,))
+        settings = {row['key']: row['value'] for row in cur}
+        with self.lock:
+            # a concurrent set_setting may have committed after our read; don't cache a stale copy
+            if self.writes == writes:
+                self.guilds[guild_id] = settings
+                if len(self.guilds) > self.maxsize:
+                    self.guilds.popitem(last=False)
+        return settings
+
+    def prime(self, guilds: Dict[int, Dict[str, Optional[str]]]):
+        with self.lock:
+            for guild_id, settings in guilds.items():
+                self.guilds[guild_id] = settings
+            while len(self.guilds) > self.maxsize:
+                self.guilds.popitem(last=False)
+
+    def set(self, guild_id: int, key: str, value: Optional[str]):
+        with self.lock:
+            self.writes += 1
+            settings = self.guilds.get(guild_id)
+            if settings is not None:
+                settings[key] = value
+
+
+settings_cache = SettingsCache(int(os.environ.get('SETTINGS_CACHE_SIZE', '10000')))
+metrics.Counter('wednesday_settings_cache_hits', 'Settings cache hits', lambda: settings_cache.hits)
+metrics.Counter('wednesday_settings_cache_misses', 'Settings cache misses', lambda: settings_cache.misses)
+
+
+@metrics.timed(db_seconds)
 def get_setting(guild_id: int, key: str, default = None) -> Optional[str]:
-    cur = db.execute('SELECT * FROM guild_settings WHERE guild_id=? AND key=? LIMIT 1', (guild_id, key))
-    for row in cur:
-        value = row['value']
-        return value if value is not None else default
-    return default
+    value = settings_cache.get(guild_id).get(key)
+    return value if value is not None else default
 
 
+@metrics.timed(db_seconds)
 def set_setting(guild_id: int, key: str, value: str):
-    cur = db.execute('INSERT OR REPLACE INTO guild_settings VALUES (?, ?, ?)', (guild_id, key, value))
-    db.commit()
+    conn = _db()
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO guild_settings VALUES (?, ?, ?)', (guild_id, key, value))
+    settings_cache.set(guild_id, key, str(value) if value is not None else None)
+    if key in ('time', 'timezone'):
+        _schedules.pop(guild_id, None)
+
+@metrics.timed(db_seconds)
+def load_all_settings() -> Dict[int, Dict[str, Optional[str]]]:
+    """Read every guild's settings in one query and prime the settings cache with them."""
+    guilds = {}
+    for row in _db().execute('SELECT guild_id, key, value FROM guild_settings'):
+        guilds.setdefault(row['guild_id'], {})[row['key']] = row['value']
+    settings_cache.prime(guilds)
+    return guilds
+
+@dataclass(frozen=True)
+class Schedule:
+    time: datetime.time
+    tz: datetime.tzinfo
+
+    def next_post(self, from_dt = None) -> datetime.datetime:
+        """Return the first Wednesday at `time` in `tz` that is not before `from_dt`."""
+        local = (from_dt or datetime.datetime.now(tz=self.tz)).astimezone(self.tz)
+        day = local.date() + datetime.timedelta(days=(2 - local.weekday()) % 7)
+        ts = datetime.datetime.combine(day, self.time, tzinfo=self.tz)
+        if ts < local:
+            ts += datetime.timedelta(days=7)
+        return ts
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name: str) -> datetime.tzinfo:
+    return dateutil.tz.gettz(name) or dateutil.tz.gettz('America/New_York')
+
+@functools.lru_cache(maxsize=None)
+def compile_schedule(time: str, timezone: str) -> Schedule:
+    """Parse a (time, timezone) setting pair once; guilds with the same settings share the result."""
+    time = datetime.time.fromisoformat(time)
+    return Schedule(datetime.time(time.hour, time.minute), get_timezone(timezone))
+
+_schedules: Dict[int, Schedule] = {}
+
+def get_guild_schedule(guild_id: int) -> Schedule:
+    schedule = _schedules.get(guild_id)
+    if schedule is None:
+        schedule = _schedules[guild_id] = settings_schedule(settings_cache.get(guild_id))
+    return schedule
+
+def settings_schedule(settings: Dict[str, Optional[str]]) -> Schedule:
+    return compile_schedule(settings.get('time') or '09:30', settings.get('timezone') or 'America/New_York')
 
 def get_schedule(guild_id: int, from_dt = None) -> datetime.datetime:
-    tz = dateutil.tz.gettz(get_setting(guild_id, 'timezone', 'America/New_York'))
-    if not tz:
-        tz = dateutil.tz.gettz('America/New_York')
-    time = datetime.time.fromisoformat(get_setting(guild_id, 'time', '09:30'))
-    ts = datetime.datetime.now(tz=tz).replace(hour=time.hour, minute=time.minute)
-    days_until_wednesday = (2 - ts.weekday()) % 7
-    ts += datetime.timedelta(days=days_until_wednesday)
-    if not from_dt:
-        from_dt = datetime.datetime.now(tz=tz)
-    while ts > from_dt:
-        ts -= datetime.timedelta(days=7)
-    if ts < from_dt:
-        ts += datetime.timedelta(days=7)
-    return ts
-
-def get_queue_depth(guild_id: int):
-    cur = db.execute('SELECT COUNT(*) FROM guild_memes WHERE guild_id=? AND last_posted IS NULL', (guild_id,))
-    return next(cur)[0]
-
-def get_global_queue_depth(guild_id: int):
-    cur = db.execute('SELECT COUNT(*) FROM global_memes WHERE approved=1 AND NOT EXISTS (SELECT 1 FROM guild_memes WHERE guild_id=? AND url=global_memes.url AND last_posted IS NULL)', (guild_id,))
-    return next(cur)[0]
+    return get_guild_schedule(guild_id).next_post(from_dt)
+
+def compute_schedule(settings: Dict[str, Optional[str]], from_dt = None) -> datetime.datetime:
+    return settings_schedule(settings).next_post(from_dt)
+
+@metrics.timed(db_seconds)
+def load_schedule_state() -> Dict[int, Tuple[Optional[datetime.datetime], Optional[datetime.datetime]]]:
+    """Return each guild's persisted (next_post, last_post) times."""
+    def parse(value):
+        return datetime.datetime.fromisoformat(value) if value else None
+    cur = _db().execute('SELECT guild_id, next_post, last_post FROM scheduled_posts')
+    return {row['guild_id']: (parse(row['next_post']), parse(row['last_post'])) for row in cur}
+
+@metrics.timed(db_seconds)
+def save_schedules(schedules: Iterable[Tuple[int, datetime.datetime]]):
+    conn = _db()
+    with conn:
+        conn.executemany('INSERT INTO scheduled_posts (guild_id, next_post) VALUES (?, ?) '
+                'ON CONFLICT (guild_id) DO UPDATE SET next_post=excluded.next_post',
+                ((guild_id, next_post.isoformat()) for guild_id, next_post in schedules))
+
+@metrics.timed(db_seconds)
+def save_schedule(guild_id: int, next_post: datetime.datetime, last_post: Optional[datetime.datetime] = None):
+    """Persist a guild's next post time, and the time of the post that just went out if there was one."""
+    conn = _db()
+    with conn:
+        conn.execute('INSERT INTO scheduled_posts (guild_id, next_post, last_post) VALUES (?, ?, ?) '
+                'ON CONFLICT (guild_id) DO UPDATE SET next_post=excluded.next_post, last_post=COALESCE(excluded.last_post, last_post)',
+                (guild_id, next_post.isoformat(), last_post.isoformat() if last_post else None))
+
+@metrics.timed(db_seconds)
+def delete_schedule(guild_id: int):
+    conn = _db()
+    with conn:
+        conn.execute('DELETE FROM scheduled_posts WHERE guild_id=?', (guild_id,))
 
+@metrics.timed(db_seconds)
+def get_queue_depth(guild_id: int) -> int:
+    """Unposted memes in the guild's own queue, read from counters maintained by triggers."""
+    return _queue_stats(guild_id)['unposted']
+
+@metrics.timed(db_seconds)
+def get_global_queue_depth(guild_id: int) -> int:
+    """Approved global memes the guild hasn't posted yet."""
+    return _queue_stats(guild_id)['global_unposted']
+
+@metrics.timed(db_seconds)
+def get_queue_stats(guild_id: int) -> Dict[str, int]:
+    return _queue_stats(guild_id)
+
+def _queue_stats(guild_id: int) -> Dict[str, int]:
+    cur = _db().execute('SELECT COALESCE(s.unposted, 0), COALESCE(s.posted, 0), g.approved - COALESCE(s.posted_global, 0) '
+            'FROM global_queue_stats g LEFT JOIN guild_queue_stats s ON s.guild_id=? WHERE g.id=0', (guild_id,))
+    unposted, posted, global_unposted = next(cur)
+    return {'unposted': unposted, 'posted': posted, 'global_unposted': global_unposted}
+
+def _random_shuffle_key() -> int:
+    return random.randint(-2**63, 2**63 - 1)
+
+# statuses recorded by the meme verifier that mean a URL can't be posted
+UNUSABLE_STATUSES = ('broken', 'too_large', 'not_image')
+_unusable = "m.status IN (%s)" % ', '.join("'%s'" % status for status in UNUSABLE_STATUSES)
+_skip_guild_meme = ('EXISTS (SELECT 1 FROM meme_metadata m WHERE m.url=guild_memes.url AND (%s OR EXISTS '
+        '(SELECT 1 FROM guild_memes d WHERE d.guild_id=guild_memes.guild_id AND d.url=m.duplicate_of)))' % _unusable)
+_skip_global_meme = ('EXISTS (SELECT 1 FROM meme_metadata m WHERE m.url=global_memes.url AND (%s OR EXISTS '
+        '(SELECT 1 FROM global_memes d WHERE d.url=m.duplicate_of)))' % _unusable)
+
+@metrics.timed(db_seconds)
 def get_guild_meme(guild_id: int) -> Optional[str]:
-    cur = db.execute('SELECT * FROM guild_memes WHERE guild_id=? AND last_posted IS NULL ORDER BY RANDOM() LIMIT 1', (guild_id,))
-    for row in cur:
-        return row['url']
-    cur = db.execute('SELECT * FROM global_memes WHERE NOT EXISTS (SELECT 1 FROM guild_memes WHERE guild_id=? AND url=global_memes.url AND last_posted IS NOT NULL) ORDER BY RANDOM() LIMIT 1', (guild_id,))
-    for row in cur:
-        return row['url']
+    """Pick an unposted meme from the guild's queue, falling back to the next unseen global meme.
+
+    Guild memes are sampled by a random offset into the guild's unposted index, bounded by its queue depth
+    counter, so no sort is needed and every meme is equally likely. Each guild walks the approved global
+    memes in `shuffle_key` order from its own cursor, wrapping around once it reaches the end. Memes the verifier
+    marked unusable, or as duplicates of an image already in the same queue, are skipped.
+    """
+    conn = _db()
+    unposted = _queue_stats(guild_id)['unposted']
+    if unposted:
+        row = conn.execute('SELECT rowid FROM guild_memes WHERE guild_id=? AND last_posted IS NULL ORDER BY rowid LIMIT 1 OFFSET ?',
+                (guild_id, random.randrange(unposted))).fetchone()
+        for start in (row[0] if row else 0, 0):
+            cur = conn.execute('SELECT url FROM guild_memes WHERE guild_id=? AND last_posted IS NULL AND rowid>=? AND NOT '
+                    + _skip_guild_meme + ' ORDER BY rowid LIMIT 1', (guild_id, start))
+            for row in cur:
+                return row['url']
+    cur = conn.execute('SELECT shuffle_key FROM global_meme_cursor WHERE guild_id=?', (guild_id,))
+    row = cur.fetchone()
+    after = row['shuffle_key'] if row else _random_shuffle_key()
+    for after in (after, None):
+        cur = conn.execute('SELECT url FROM global_memes WHERE shuffle_key>COALESCE(?, -9223372036854775808) AND approved AND NOT EXISTS (SELECT 1 FROM guild_memes WHERE guild_id=? AND url=global_memes.url AND last_posted IS NOT NULL) AND NOT '
+                + _skip_global_meme + ' ORDER BY shuffle_key LIMIT 1', (after, guild_id))
+        for row in cur:
+            return row['url']
     print('no unused memes found')
 
+@metrics.timed(db_seconds)
 def mark_guild_meme(guild_id: int, url: str):
-    cur = db.execute("INSERT OR REPLACE INTO guild_memes (guild_id, url, last_posted) VALUES (?, ?, datetime('now'))", (guild_id, url))
-    db.commit()
+    conn = _db()
+    # not REPLACE, which deletes the old row without firing the queue stats triggers, nor an upsert, whose
+    # conflict policy overrides the INSERT OR IGNORE in the update trigger
+    with conn:
+        cur = conn.execute("UPDATE guild_memes SET last_posted=datetime('now') WHERE guild_id=? AND url=?", (guild_id, url))
+        if not cur.rowcount:
+            conn.execute("INSERT INTO guild_memes (guild_id, url, last_posted) VALUES (?, ?, datetime('now'))", (guild_id, url))
+        conn.execute('INSERT INTO global_meme_cursor (guild_id, shuffle_key) SELECT ?, shuffle_key FROM global_memes WHERE url=? '
+                'ON CONFLICT (guild_id) DO UPDATE SET shuffle_key=excluded.shuffle_key', (guild_id, url))
 
+@metrics.timed(db_seconds)
 def add_guild_meme(guild_id: int, url: str, submitter: Optional[int] = None):
-    cur = db.execute('INSERT INTO guild_memes (guild_id, url, submitter) VALUES (?, ?, ?)', (guild_id, url, submitter))
-    db.commit()
+    conn = _db()
+    with conn:
+        conn.execute('INSERT INTO guild_memes (guild_id, url, submitter) VALUES (?, ?, ?)', (guild_id, url, submitter))
 
+@metrics.timed(db_seconds)
 def add_global_meme(url: str, approved: Optional[bool] = False, submitter: Optional[int] = None):
     if approved is None:
         approved = 0
-    cur = db.execute('INSERT INTO global_memes (url, approved, submitter) VALUES (?, ?, ?)', (url, approved, submitter))
-    db.commit()
+    conn = _db()
+    with conn:
+        conn.execute('INSERT INTO global_memes (url, approved, submitter, shuffle_key) VALUES (?, ?, ?, ?)',
+                (url, approved, submitter, _random_shuffle_key()))
+
+@metrics.timed(db_seconds)
+def add_guild_memes(guild_id: int, urls: Iterable[str], submitter: Optional[int] = None) -> int:
+    """Add many memes to a guild's queue in one transaction, skipping ones it already has."""
+    conn = _db()
+    with conn:
+        # rowcount, unlike total_changes, leaves out the rows the queue stats triggers write
+        return conn.executemany('INSERT OR IGNORE INTO guild_memes (guild_id, url, submitter) VALUES (?, ?, ?)',
+                ((guild_id, url, submitter) for url in urls)).rowcount
+
+@metrics.timed(db_seconds)
+def add_global_memes(urls: Iterable[str], approved: Optional[bool] = False, submitter: Optional[int] = None) -> int:
+    """Add many memes to the global queue in one transaction, skipping ones it already has."""
+    conn = _db()
+    with conn:
+        return conn.executemany('INSERT OR IGNORE INTO global_memes (url, approved, submitter, shuffle_key) VALUES (?, ?, ?, ?)',
+                ((url, approved or 0, submitter, _random_shuffle_key()) for url in urls)).rowcount
+
+def iter_guild_memes(guild_id: int) -> Iterator[sqlite3.Row]:
+    return _db().execute('SELECT url, submitter, last_posted FROM guild_memes WHERE guild_id=? ORDER BY rowid', (guild_id,))
+
+def iter_global_memes() -> Iterator[sqlite3.Row]:
+    return _db().execute('SELECT url, approved, submitter FROM global_memes ORDER BY rowid')
 
-def log_event(event: str, payload: Optional[Dict[str, Any]] = None):
+@metrics.timed(db_seconds)
+def get_unverified_memes(limit: int, max_age: datetime.timedelta) -> List[str]:
+    """Queued guild memes and global memes never verified, or last verified more than `max_age` ago."""
+    conn = _db()
+    modifier = '-%d seconds' % max_age.total_seconds()
+    urls = {}
+    for query in ('SELECT url FROM global_memes', 'SELECT url FROM guild_memes WHERE last_posted IS NULL'):
+        cur = conn.execute('SELECT url FROM (' + query + ') u WHERE NOT EXISTS (SELECT 1 FROM meme_metadata m '
+                "WHERE m.url=u.url AND m.last_verified>=datetime('now', ?)) LIMIT ?", (modifier, limit))
+        for row in cur:
+            urls[row['url']] = None
+        if len(urls) >= limit:
+            break
+    return list(urls)[:limit]
+
+@metrics.timed(db_seconds)
+def save_meme_metadata(rows: Iterable[Dict[str, Any]]):
+    """Record verification results.
+
+    A URL whose content hash matches a working URL verified before it is recorded as a duplicate of that
+    URL. Rows with the `error` status (timeouts, server errors) only update the status, keeping the last
+    known content details.
+    """
+    rows = list(rows)
+    conn = _db()
+    with conn:
+        conn.executemany('INSERT INTO meme_metadata (url, status, content_type, size, hash, duplicate_of, last_verified) '
+                'VALUES (:url, :status, :content_type, :size, :hash, (SELECT MIN(url) FROM meme_metadata WHERE hash=:hash '
+                "AND url<>:url AND status='ok' AND duplicate_of IS NULL), datetime('now')) ON CONFLICT (url) DO UPDATE SET status=excluded.status, "
+                'content_type=excluded.content_type, size=excluded.size, hash=excluded.hash, '
+                'duplicate_of=excluded.duplicate_of, last_verified=excluded.last_verified',
+                (row for row in rows if row['status'] != 'error'))
+        conn.executemany("INSERT INTO meme_metadata (url, status, last_verified) VALUES (:url, :status, datetime('now')) "
+                'ON CONFLICT (url) DO UPDATE SET status=excluded.status, last_verified=excluded.last_verified',
+                (row for row in rows if row['status'] == 'error'))
+
+@metrics.timed(db_seconds)
+def get_meme_metadata(url: str) -> Optional[sqlite3.Row]:
+    return _db().execute('SELECT * FROM meme_metadata WHERE url=?', (url,)).fetchone()
+
+class EventBuffer:
+    """Bounded queue of pending event_log rows, written in one transaction per flush.
+
+    Events arriving while the queue is full are dropped and counted rather than blocking the caller.
+    """
+
+    def __init__(self, maxsize: int, batch_size: int):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.rows = []
+        self.flushed = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def put(self, event: str, payload: str, guild_id: Optional[int] = None) -> bool:
+        """Queue an event, returning True once a flush is due."""
+        timestamp = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock:
+            if len(self.rows) >= self.maxsize:
+                self.dropped += 1
+            else:
+                self.rows.append((timestamp, event, payload, guild_id or 0))
+            return len(self.rows) >= self.batch_size
+
+    def flush(self, conn: sqlite3.Connection) -> int:
+        with self.lock:
+            rows, self.rows = self.rows, []
+        if not rows:
+            return 0
+        rollup = Counter((timestamp[:10], event, guild_id) for timestamp, event, _, guild_id in rows)
+        try:
+            with conn:
+                conn.executemany('INSERT INTO event_log (timestamp, event, payload) VALUES (?, ?, ?)',
+                        (row[:3] for row in rows))
+                conn.executemany('INSERT INTO event_rollup (day, event, guild_id, count) VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT (day, event, guild_id) DO UPDATE SET count=count+excluded.count',
+                        (key + (count,) for key, count in rollup.items()))
+        except sqlite3.Error:
+            logging.exception('failed to write %d events', len(rows))
+            with self.lock:
+                self.dropped += len(rows)
+            return 0
+        with self.lock:
+            self.flushed += len(rows)
+        return len(rows)
+
+
+event_buffer = EventBuffer(int(os.environ.get('EVENT_QUEUE_SIZE', '10000')),
+        int(os.environ.get('EVENT_BATCH_SIZE', '500')))
+metrics.Counter('wednesday_events_flushed', 'Events written to the event log', lambda: event_buffer.flushed)
+metrics.Counter('wednesday_events_dropped', 'Events dropped because the event buffer was full', lambda: event_buffer.dropped)
+metrics.Gauge('wednesday_events_pending', 'Events waiting to be flushed', lambda: len(event_buffer))
+
+
+def log_event(event: str, payload: Optional[Dict[str, Any]] = None) -> bool:
+    """Buffer an event for the event log, returning True once the buffer should be flushed."""
     if not payload:
         payload = dict()
-    logging.info("%s %s", event, json.dumps(payload))
-    cur = db.execute("INSERT INTO event_log (timestamp, event, payload) VALUES (datetime('now'), ?, ?)", (event, json.dumps(payload)))
-    db.commit()
+    guild_id = payload.get('guild_id')
+    payload = json.dumps(payload, default=str)
+    logging.info("%s %s", event, payload)
+    return event_buffer.put(event, payload, guild_id)
+
+@metrics.timed(db_seconds)
+def flush_events() -> int:
+    return event_buffer.flush(_db())
+
+@metrics.timed(db_seconds)
+def get_event_count(event: str, day: datetime.date, guild_id: Optional[int] = None) -> int:
+    """Count events on a UTC day from the rollup table, for one guild or all of them."""
+    if guild_id is None:
+        cur = _db().execute('SELECT SUM(count) FROM event_rollup WHERE day=? AND event=?', (day.isoformat(), event))
+    else:
+        cur = _db().execute('SELECT count FROM event_rollup WHERE day=? AND event=? AND guild_id=?',
+                (day.isoformat(), event, guild_id))
+    row = cur.fetchone()
+    return row[0] or 0 if row else 0
+
+@metrics.timed(db_seconds)
+def prune_event_log(before: datetime.datetime, archive_dir: Optional[str] = None, limit: int = 10000) -> int:
+    """Delete up to `limit` events older than `before`, optionally archiving them to monthly gzipped JSONL files.
+
+    Returns the number of rows deleted; call repeatedly until it returns 0. Rollups are kept.
+    """
+    conn = _db()
+    cutoff = before.astimezone(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    rows = conn.execute('SELECT rowid, timestamp, event, payload FROM event_log WHERE timestamp < ? ORDER BY rowid LIMIT ?',
+            (cutoff, limit)).fetchall()
+    if not rows:
+        return 0
+    if archive_dir:
+        os.makedirs(archive_dir, exist_ok=True)
+        months = {}
+        for row in rows:
+            months.setdefault(row['timestamp'][:7], []).append(row)
+        for month, month_rows in months.items():
+            with gzip.open(os.path.join(archive_dir, 'event_log-%s.jsonl.gz' % month), 'at') as f:
+                for row in month_rows:
+                    f.write(json.dumps({'timestamp': row['timestamp'], 'event': row['event'],
+                        'payload': json.loads(row['payload'])}) + '\n')
+    with conn:
+        conn.executemany('DELETE FROM event_log WHERE rowid=?', ((row['rowid'],) for row in rows))
+    return len(rows)
+
+@metrics.timed(db_seconds)
+def backup(path: str, compress: bool = False, pages: int = 256, sleep: float = 0.01) -> Dict[str, Any]:
+    """Snapshot the live database to `path` with SQLite's online backup API, `pages` pages per step.
+
+    The source connection holds a read transaction for the whole copy, so the snapshot is taken as of the
+    start and writes from this or any other process don't restart it. The snapshot is renamed into place
+    once complete, gzipped first if `compress`.
+    """
+    started = time.monotonic()
+    progress = {}
+    tmp = path + '.part'
+    source = connect()
+    target = sqlite3.connect(tmp)
+    try:
+        source.execute('BEGIN')
+        source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        source.backup(target, pages=pages, sleep=sleep, progress=lambda status, remaining, total: progress.update(pages=total))
+    finally:
+        target.close()
+        source.close()
+    db_size = os.path.getsize(tmp)
+    if compress:
+        with open(tmp, 'rb') as src, gzip.open(tmp + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        os.remove(tmp)
+        tmp += '.gz'
+    os.replace(tmp, path)
+    return {'path': path, 'pages': progress.get('pages'), 'db_size': db_size, 'size': os.path.getsize(path),
+        'duration': time.monotonic() - started}
+
+@metrics.timed(db_seconds)
+def vacuum() -> Dict[str, Any]:
+    """Rebuild the database file to drop free pages, then truncate the WAL. Other writes wait until it finishes."""
+    started = time.monotonic()
+    conn = _db()
+    before = next(conn.execute('PRAGMA page_count'))[0]
+    conn.execute('VACUUM')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    after = next(conn.execute('PRAGMA page_count'))[0]
+    return {'pages_before': before, 'pages_after': after, 'duration': time.monotonic() - started}
+
+
+atexit.register(flush_events)
@@ -0,0 +1,39 @@
+import discord
+from typing import Dict, Optional
+
+
+class GuildIndex:
+    """O(1) lookups of a guild's text channels and emojis by name.
+
+    Guilds themselves are looked up with `Client.get_guild`. The index is kept current from gateway
+    events; guilds that haven't been added yet are indexed on first use.
+    """
+
+    def __init__(self):
+        self.channels: Dict[int, Dict[str, discord.TextChannel]] = {}
+        self.emojis: Dict[int, Dict[str, discord.Emoji]] = {}
+
+    def add_guild(self, guild: discord.Guild):
+        self.update_channels(guild)
+        self.update_emojis(guild, guild.emojis)
+
+    def remove_guild(self, guild_id: int):
+        self.channels.pop(guild_id, None)
+        self.emojis.pop(guild_id, None)
+
+    def update_channels(self, guild: discord.Guild):
+        # reversed so the first channel with a given name wins, like discord.utils.get
+        self.channels[guild.id] = {channel.name: channel for channel in reversed(guild.text_channels)}
+
+    def update_emojis(self, guild: discord.Guild, emojis):
+        self.emojis[guild.id] = {emoji.name: emoji for emoji in reversed(emojis)}
+
+    def channel(self, guild: discord.Guild, name: str) -> Optional[discord.TextChannel]:
+        if guild.id not in self.channels:
+            self.add_guild(guild)
+        return self.channels[guild.id].get(name)
+
+    def emoji(self, guild: discord.Guild, name: str) -> Optional[discord.Emoji]:
+        if guild.id not in self.emojis:
+            self.add_guild(guild)
+        return self.emojis[guild.id].get(name)
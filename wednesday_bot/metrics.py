@@ -0,0 +1,186 @@
+"""Prometheus-style metrics, served over HTTP when METRICS_PORT is set.
+
+When metrics are disabled, `timed` returns functions undecorated, so instrumentation costs nothing.
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+
+enabled = bool(os.environ.get('METRICS_PORT'))
+registry = []
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def render(self):
+        yield '# HELP %s %s' % (self.name, self.help)
+        yield '# TYPE %s %s' % (self.name, self.type)
+
+
+class Counter(Metric):
+    """A counter incremented explicitly, or read from `fn` at scrape time for totals kept elsewhere."""
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, help)
+        self.fn = fn
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        yield from super().render()
+        if self.fn:
+            try:
+                yield '%s %s' % (self.name, self.fn())
+            except Exception:
+                logging.exception('failed to read counter %s', self.name)
+        for key, value in list(self.values.items()):
+            yield '%s%s %s' % (self.name, _labels(key), value)
+
+
+class Gauge(Metric):
+    """A gauge set explicitly, or read from `fn` at scrape time."""
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, help)
+        self.fn = fn
+        self.values: Dict[Tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        self.values[_key(labels)] = value
+
+    def render(self):
+        yield from super().render()
+        if self.fn:
+            try:
+                yield '%s %s' % (self.name, self.fn())
+            except Exception:
+                logging.exception('failed to read gauge %s', self.name)
+        for key, value in list(self.values.items()):
+            yield '%s%s %s' % (self.name, _labels(key), value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        self.values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = _key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket, then +Inf, sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def render(self):
+        yield from super().render()
+        for key, counts in list(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield '%s_bucket%s %s' % (self.name, _labels(key + (('le', str(bound)),)), total)
+            yield '%s_sum%s %s' % (self.name, _labels(key), counts[-1])
+            yield '%s_count%s %s' % (self.name, _labels(key), total)
+
+
+class timer:
+    """Context manager observing the elapsed time into a histogram."""
+
+    def __init__(self, histogram: Histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+def timed(histogram: Histogram):
+    """Decorate a function or coroutine function to observe its run time, labelled with its name."""
+    def decorator(fn):
+        if not enabled:
+            return fn
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with timer(histogram, function=fn.__name__):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with timer(histogram, function=fn.__name__):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        if request.split(b' ')[1:2] == [b'/metrics']:
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(('HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n'
+            % (status, len(body))).encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(host: str = os.environ.get('METRICS_HOST', '127.0.0.1'), port: int = int(os.environ.get('METRICS_PORT') or 0)):
+    return await asyncio.start_server(_handle, host, port)
+
+
+async def monitor_event_loop(histogram: Histogram, interval: float = 0.25):
+    """Observe how late the event loop wakes from a sleep, i.e. how long it was blocked."""
+    loop = asyncio.get_event_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, loop.time() - started - interval))
+
+
+def _key(labels) -> Tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _labels(key) -> str:
+    if not key:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in key)
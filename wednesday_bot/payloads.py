@@ -0,0 +1,45 @@
+import discord
+from typing import Dict, Optional, Tuple, Union
+
+
+CLASSIC_URL = 'https://i.kym-cdn.com/photos/images/original/001/091/264/665.jpg'
+
+Emoji = Union[discord.Emoji, str]
+
+
+class PayloadCache:
+    """Prepared post payloads, plus each guild's resolved emoji and effective mode.
+
+    Embeds are read-only once built, so the Classic embed and Text messages are shared by every guild
+    using the same emoji. Guild entries must be invalidated when the emoji, mode or bot permissions change.
+    """
+
+    def __init__(self):
+        self.classic_embed = discord.Embed()
+        self.classic_embed.set_image(url=CLASSIC_URL)
+        self.texts: Dict[str, str] = {}
+        self.guilds: Dict[int, Tuple[Emoji, str]] = {}
+
+    def text(self, emoji: Emoji) -> str:
+        key = str(emoji)
+        content = self.texts.get(key)
+        if content is None:
+            content = self.texts[key] = key + ' It is Wednesday, my dudes.'
+        return content
+
+    def variety_embed(self, url: str) -> discord.Embed:
+        if url == CLASSIC_URL:
+            return self.classic_embed
+        embed = discord.Embed()
+        embed.set_image(url=url)
+        return embed
+
+    def get(self, guild_id: int) -> Optional[Tuple[Emoji, str]]:
+        return self.guilds.get(guild_id)
+
+    def set(self, guild_id: int, emoji: Emoji, mode: str) -> Tuple[Emoji, str]:
+        resolved = self.guilds[guild_id] = (emoji, mode)
+        return resolved
+
+    def invalidate(self, guild_id: int):
+        self.guilds.pop(guild_id, None)
@@ -0,0 +1,67 @@
+import discord
+import os
+from typing import Dict, FrozenSet, Optional, Tuple
+
+
+SUPER_ADMIN = int(os.environ['DISCORD_SUPER_ADMIN'])
+
+
+class RoleCache:
+    """Each guild's admin and submitter role ids, resolved from its settings once.
+
+    A submitter role that is unset or no longer exists resolves to the default role, so everyone may
+    submit. Guild entries must be invalidated when the role settings change or a role is deleted.
+    """
+
+    def __init__(self):
+        self.guilds: Dict[int, Tuple[int, int]] = {}
+
+    def get(self, guild_id: int) -> Optional[Tuple[int, int]]:
+        return self.guilds.get(guild_id)
+
+    def set(self, guild: discord.Guild, admin_role_id: int, submitter_role_id: int) -> Tuple[int, int]:
+        if guild.get_role(submitter_role_id) is None:
+            submitter_role_id = guild.default_role.id
+        resolved = self.guilds[guild.id] = (admin_role_id, submitter_role_id)
+        return resolved
+
+    def invalidate(self, guild_id: int):
+        self.guilds.pop(guild_id, None)
+
+
+class MemberRoleCache:
+    """Each member's role ids as a set, built from `member.roles` once.
+
+    Only correct while the bot receives member updates (the members intent). Member entries must be
+    invalidated when the member is updated or leaves, and guild entries when a role is deleted.
+    """
+
+    def __init__(self):
+        self.guilds: Dict[int, Dict[int, FrozenSet[int]]] = {}
+
+    def get(self, member: discord.Member) -> FrozenSet[int]:
+        members = self.guilds.setdefault(member.guild.id, {})
+        role_ids = members.get(member.id)
+        if role_ids is None:
+            role_ids = members[member.id] = frozenset(role.id for role in member.roles)
+        return role_ids
+
+    def invalidate(self, guild_id: int, member_id: Optional[int] = None):
+        if member_id is None:
+            self.guilds.pop(guild_id, None)
+        else:
+            self.guilds.get(guild_id, {}).pop(member_id, None)
+
+
+def has_role(member: discord.Member, role_id: int, cache: Optional[MemberRoleCache] = None) -> bool:
+    """Whether `member` has the role. Without `cache` or discord.py 2.0's `Member.get_role`, this
+    builds the sorted `member.roles` list on every call."""
+    if role_id == member.guild.id:
+        # everyone has the default role
+        return True
+    get_role = getattr(member, 'get_role', None)
+    if get_role is not None:
+        return get_role(role_id) is not None
+    if cache is not None:
+        return role_id in cache.get(member)
+    return role_id in {role.id for role in member.roles}
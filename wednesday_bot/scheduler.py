@@ -1,41 +1,283 @@
 import asyncio
+import collections
 import datetime
 from dataclasses import dataclass, field
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional, Callable, Set
 import heapq
 import logging
+import time
 import traceback
+import zlib
 
 
 class Scheduler:
-    def __init__(self, interval=60):
+    def __init__(self, interval=3600, concurrency=1, rate=None, on_batch: Optional[Callable] = None, spread_rate=None):
         self.interval = interval
         self.heap = []
+        self.tasks = {}
+        self.groups = {}
+        self.members = {}
+        self.cancelled = 0
+        self.wakeup = asyncio.Event()
+        self.wakeup_lag = 0.0
+        self.concurrency = max(1, concurrency)
+        self.limiter = RateLimiter(rate) if rate else None
+        self.slots = SlotAllocator(spread_rate)
+        self.on_batch = on_batch
+        self.last_batch = None
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    @property
+    def pending(self) -> int:
+        """Number of keyed tasks and group members waiting to run."""
+        return len(self.tasks) + len(self.members)
 
     def schedule(self, time, fn, *args, **kwargs):
-        task = ScheduledTask(time, fn, args, kwargs)
+        return self._push(ScheduledTask(time, fn, args, kwargs))
+
+    def reschedule(self, key, time, fn=None, *args, **kwargs):
+        """Replace the task scheduled under `key`, reusing its callback if `fn` is not given."""
+        old = self.cancel(key)
+        if fn is None:
+            if old is None:
+                raise KeyError(key)
+            fn, args, kwargs = old.fn, old.args, old.kwargs
+        task = ScheduledTask(time, fn, args, kwargs, key=key)
+        self.tasks[key] = task
+        return self._push(task)
+
+    def cancel(self, key):
+        """Cancel the task scheduled under `key` in O(1), leaving a tombstone in the heap."""
+        task = self.tasks.pop(key, None)
+        if task is not None:
+            self._tombstone(task)
+        return task
+
+    def join(self, key, time, fn, window: float = 0):
+        """Move `key` into the group that calls `fn(key, time)` at `time`.
+
+        Keys sharing a time and callback share a single heap entry, which fans out to one call per key
+        when it comes due. With a `window` of N seconds, the key may be moved up to N seconds either side
+        of `time` to keep sends under the spread rate; the group's time is the one assigned.
+        """
+        group = self._join(key, time, fn, window)
+        if len(group.members) == 1:
+            self._push(group)
+        return group
+
+    def join_many(self, items):
+        """Join many (key, time, fn) or (key, time, fn, window) items at once, heapifying once."""
+        for item in items:
+            group = self._join(*item)
+            if len(group.members) == 1:
+                self.heap.append(group)
+        heapq.heapify(self.heap)
+        self.wakeup.set()
+
+    def leave(self, key):
+        self.slots.release(key)
+        group = self.members.pop(key, None)
+        if group is not None:
+            group.members.discard(key)
+            if not group.members:
+                del self.groups[(group.time, group.fn)]
+                self._tombstone(group)
+        return group
+
+    def _join(self, key, time, fn, window=0):
+        self.leave(key)
+        time = self.slots.assign(key, time, window)
+        group = self.groups.get((time, fn))
+        if group is None:
+            group = self.groups[(time, fn)] = ScheduledTask(time, fn, (), {}, members=set())
+        group.members.add(key)
+        self.members[key] = group
+        return group
+
+    def _tombstone(self, task):
+        task.cancelled = True
+        self.cancelled += 1
+        if self.cancelled > 64 and self.cancelled > len(self.heap) // 2:
+            self.heap = [x for x in self.heap if not x.cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    def _push(self, task):
         logging.debug(task)
         heapq.heappush(self.heap, task)
+        if self.heap[0] is task:
+            self.wakeup.set()
+        return task
+
+    def _pop(self):
+        task = heapq.heappop(self.heap)
+        if task.cancelled:
+            self.cancelled -= 1
+        elif task.members is not None:
+            del self.groups[(task.time, task.fn)]
+            for key in task.members:
+                del self.members[key]
+        elif task.key is not None:
+            del self.tasks[task.key]
+        return task
+
+    def _head(self):
+        while self.heap and self.heap[0].cancelled:
+            self._pop()
+        return self.heap[0] if self.heap else None
+
+    @property
+    def lag(self) -> float:
+        """Seconds the earliest pending task is overdue, or 0 if nothing is due yet."""
+        head = self._head()
+        if head is None:
+            return 0.0
+        return max(0.0, _latency(head))
 
     async def tick(self):
-        logging.debug(datetime.datetime.now(tz=datetime.timezone.utc))
-        while len(self.heap) > 0 and self.heap[0].time <= datetime.datetime.now(tz=datetime.timezone.utc):
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        logging.debug(now)
+        batch = []
+        while len(self.heap) > 0 and self.heap[0].time <= now:
+            task = self._pop()
+            if task.cancelled:
+                continue
+            elif task.members is not None:
+                batch.extend(ScheduledTask(task.time, task.fn, (key, task.time), {}, key=key) for key in task.members)
+            else:
+                batch.append(task)
+        if batch:
+            self.wakeup_lag = (now - batch[0].time).total_seconds()
+            await self.dispatch(batch)
+
+    async def dispatch(self, batch):
+        """Run a batch of due tasks through a pool of at most `concurrency` workers."""
+        queue = asyncio.Queue()
+        for task in batch:
+            queue.put_nowait(task)
+        start_latencies = []
+        end_latencies = []
+        failures = 0
+
+        async def worker():
+            nonlocal failures
+            while True:
+                try:
+                    task = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                if self.limiter:
+                    await self.limiter.acquire()
+                start_latencies.append(_latency(task))
+                try:
+                    res = task.fn(*task.args, **task.kwargs)
+                    if asyncio.iscoroutine(res):
+                        await res
+                except:
+                    failures += 1
+                    traceback.print_exc()
+                end_latencies.append(_latency(task))
+
+        started = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(batch)))))
+        self.last_batch = BatchStats(
+            size=len(batch),
+            failures=failures,
+            duration=time.monotonic() - started,
+            start_latency_p50=_percentile(start_latencies, 0.5),
+            start_latency_max=max(start_latencies),
+            end_latency_p50=_percentile(end_latencies, 0.5),
+            end_latency_p95=_percentile(end_latencies, 0.95),
+            end_latency_max=max(end_latencies),
+        )
+        logging.info('dispatched %s', self.last_batch)
+        if self.on_batch:
             try:
-                task = heapq.heappop(self.heap)
-                res = task.fn(*task.args, **task.kwargs)
-                if asyncio.iscoroutine(res):
-                    await res
+                self.on_batch(self.last_batch)
             except:
                 traceback.print_exc()
 
+    async def run(self):
+        """Sleep until the earliest task is due, waking early if a sooner task is scheduled.
+
+        Sleeps are capped at `interval` seconds so wall clock adjustments are picked up.
+        """
+        while True:
+            self.wakeup.clear()
+            await self.tick()
+            head = self._head()
+            if head is not None:
+                delay = min(self.interval, -_latency(head))
+            else:
+                delay = self.interval
+            if delay <= 0:
+                continue
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
 
 
-    async def run(self):
+class RateLimiter:
+    """Token bucket allowing `rate` acquisitions per second with bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
         while True:
-            await asyncio.gather(
-                self.tick(),
-                asyncio.sleep(60),
-            )
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SlotAllocator:
+    """Assigns send times to keys in one-second slots, holding each slot to at most `rate` keys.
+
+    A key with a window starts from a deterministic offset derived from the key and takes the nearest slot
+    within the window that has room, so the same keys land in the same slots every week. Keys without a
+    window keep their time but still count against its slot. If the whole window is full, the key keeps
+    its preferred slot.
+    """
+
+    def __init__(self, rate: Optional[float] = None):
+        self.rate = rate
+        self.counts = collections.Counter()
+        self.assigned = {}
+
+    def assign(self, key, time: datetime.datetime, window: float = 0) -> datetime.datetime:
+        self.release(key)
+        window = int(window)
+        if window <= 0 and not self.rate:
+            return time
+        base = int(time.timestamp())
+        offset = zlib.crc32(str(key).encode()) % (2 * window + 1) - window if window else 0
+        slot = base + offset
+        if self.rate:
+            for step in range(4 * window + 1):
+                candidate = slot + (step + 1) // 2 * (1 if step % 2 else -1)
+                if abs(candidate - base) <= window and self.counts[candidate] < self.rate:
+                    slot = candidate
+                    break
+            self.counts[slot] += 1
+            self.assigned[key] = slot
+        return time + datetime.timedelta(seconds=slot - base)
+
+    def release(self, key):
+        slot = self.assigned.pop(key, None)
+        if slot is not None:
+            self.counts[slot] -= 1
+            if not self.counts[slot]:
+                del self.counts[slot]
 
 
 @dataclass(order=True)
@@ -44,3 +286,27 @@ class ScheduledTask:
     fn: Any = field(compare=False)
     args: List[Any] = field(compare=False)
     kwargs: Dict[str, Any] = field(compare=False)
+    key: Any = field(default=None, compare=False)
+    cancelled: bool = field(default=False, compare=False)
+    members: Optional[Set[Any]] = field(default=None, compare=False)
+
+
+@dataclass
+class BatchStats:
+    size: int
+    failures: int
+    duration: float
+    start_latency_p50: float
+    start_latency_max: float
+    end_latency_p50: float
+    end_latency_p95: float
+    end_latency_max: float
+
+
+def _latency(task):
+    return (datetime.datetime.now(tz=datetime.timezone.utc) - task.time).total_seconds()
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
@@ -0,0 +1,179 @@
+"""Background verification of queued meme URLs.
+
+Each URL is fetched once with a bounded pool of connections. The verifier records whether it is a
+usable image, its size and a hash of its content, so meme selection can skip dead, oversized or
+duplicate memes without touching the network.
+
+URLs are submitted by users, so only public hosts are fetched: addresses are checked after every DNS
+lookup, and redirects are followed one at a time so each hop is checked too.
+"""
+import asyncio
+import datetime
+import hashlib
+import ipaddress
+import logging
+from typing import Any, Collection, Dict, List
+
+import aiohttp
+import yarl
+
+from . import metrics
+from .async_database import get_unverified_memes, save_meme_metadata, log_event
+
+
+verified = metrics.Counter('wednesday_memes_verified', 'Meme URLs checked by the verifier, by status')
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class UnsafeURL(aiohttp.ClientError):
+    """A URL the verifier won't fetch: not http(s), or on a loopback, private or other non-public host."""
+
+
+def is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+class PublicResolver(aiohttp.DefaultResolver):
+    """Refuses to connect to names that resolve to any non-public address, other than `allowed_hosts`."""
+
+    def __init__(self, allowed_hosts: Collection[str] = (), *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.allowed_hosts = allowed_hosts
+
+    async def resolve(self, host, *args, **kwargs):
+        hosts = await super().resolve(host, *args, **kwargs)
+        if host not in self.allowed_hosts and not all(is_public_address(h['host']) for h in hosts):
+            raise UnsafeURL('%s resolves to a non-public address' % host)
+        return hosts
+
+
+class MemeVerifier:
+    """Checks unverified memes in batches with at most `concurrency` requests in flight."""
+
+    def __init__(self, concurrency: int = 8, max_size: int = 8 << 20, timeout: float = 30,
+            max_age: datetime.timedelta = datetime.timedelta(days=7), batch_size: int = 200,
+            max_redirects: int = 10, allowed_hosts: Collection[str] = ()):
+        self.concurrency = concurrency
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.max_redirects = max_redirects
+        # non-public hosts to fetch from anyway, only for testing against a local host
+        self.allowed_hosts = allowed_hosts
+        self.wakeup = asyncio.Event()
+
+    def wake(self):
+        """Start the next pass now rather than at the next interval, e.g. after new memes are submitted."""
+        self.wakeup.set()
+
+    def check_url(self, url: yarl.URL):
+        if url.scheme not in ('http', 'https'):
+            raise UnsafeURL('unsupported scheme in %s' % url)
+        if url.host in self.allowed_hosts:
+            return
+        try:
+            public = is_public_address(url.host or '')
+        except ValueError:
+            # a name, which the resolver checks
+            return
+        if not public:
+            raise UnsafeURL('%s is not a public address' % url.host)
+
+    async def fetch(self, session: aiohttp.ClientSession, url: str) -> aiohttp.ClientResponse:
+        """GET `url`, checking the host of each redirect before following it."""
+        url = yarl.URL(url)
+        for _ in range(self.max_redirects + 1):
+            self.check_url(url)
+            resp = await session.get(url, allow_redirects=False)
+            if resp.status not in REDIRECT_STATUSES or 'Location' not in resp.headers:
+                return resp
+            resp.release()
+            url = resp.url.join(yarl.URL(resp.headers['Location']))
+        raise aiohttp.TooManyRedirects(resp.request_info, ())
+
+    async def check(self, session: aiohttp.ClientSession, url: str) -> Dict[str, Any]:
+        result = {'url': url, 'status': 'error', 'content_type': None, 'size': None, 'hash': None}
+        try:
+            async with await self.fetch(session, url) as resp:
+                if 400 <= resp.status < 500 and resp.status != 429:
+                    result['status'] = 'broken'
+                    return result
+                if resp.status >= 300:
+                    return result
+                result['content_type'] = resp.content_type
+                if not resp.content_type.startswith('image/'):
+                    result['status'] = 'not_image'
+                    return result
+                if resp.content_length is not None and resp.content_length > self.max_size:
+                    result['size'] = resp.content_length
+                    result['status'] = 'too_large'
+                    return result
+                digest = hashlib.sha256()
+                size = 0
+                async for chunk in resp.content.iter_chunked(1 << 16):
+                    size += len(chunk)
+                    if size > self.max_size:
+                        result['size'] = size
+                        result['status'] = 'too_large'
+                        return result
+                    digest.update(chunk)
+                result.update(status='ok', size=size, hash=digest.hexdigest())
+        except (aiohttp.InvalidURL, UnsafeURL):
+            result['status'] = 'broken'
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.debug('failed to verify %s: %r', url, e)
+        return result
+
+    async def verify(self, session: aiohttp.ClientSession, urls: List[str]) -> List[Dict[str, Any]]:
+        """Check `urls` with a pool of workers and save the results."""
+        queue = asyncio.Queue()
+        for url in urls:
+            queue.put_nowait(url)
+        results = []
+
+        async def worker():
+            while not queue.empty():
+                results.append(await self.check(session, queue.get_nowait()))
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(urls)))))
+        await save_meme_metadata(results)
+        for result in results:
+            verified.inc(status=result['status'])
+        return results
+
+    def session(self) -> aiohttp.ClientSession:
+        resolver = PublicResolver(self.allowed_hosts)
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency, resolver=resolver),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def run_once(self) -> int:
+        """Verify memes until none are due, reusing one connection pool for the whole pass."""
+        total = 0
+        async with self.session() as session:
+            while True:
+                urls = await get_unverified_memes(self.batch_size, self.max_age)
+                if not urls:
+                    break
+                await self.verify(session, urls)
+                total += len(urls)
+        return total
+
+    async def run(self, interval: float = 3600):
+        while True:
+            self.wakeup.clear()
+            started = asyncio.get_event_loop().time()
+            try:
+                count = await self.run_once()
+                if count:
+                    log_event('verify_memes', {'count': count, 'duration': asyncio.get_event_loop().time() - started})
+            except Exception:
+                logging.exception('meme verification failed')
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass